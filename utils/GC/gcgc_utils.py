@@ -6,6 +6,7 @@ import os
 import glob
 import scipy.integrate as integrate
 import matplotlib.colors
+from concurrent.futures import ProcessPoolExecutor
 
 
 
@@ -21,6 +22,62 @@ def parse_chromatogram(path)->pd.DataFrame:
     return df
 
 
+def count_rows(filepath, chunk_bytes = 2**24)->int:
+    '''Number of lines in a file, read in blocks of chunk_bytes'''
+    lines = 0
+    last = b'\n'
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+def read_chromatogram_2D(filepath, split_time: float, sampling_interval: float, solvent_time: float =0, chunksize: int =2**18, memmap_path=None, offset=0, reference=None)->np.ndarray:
+    '''
+    Streams a FID chromatogram from a .csv file straight into a 2D chromatogram, same as parse_chromatogram, split_solvent, add_split and convert_to2D.
+    Only the time and intensity columns are read, chunksize rows at a time, and the intensity is set to 0 up to solvent_time on the fly.
+    The modulations are written into a preallocated array, or a memory-mapped .npy file at memmap_path, so the memory used is about the size of the 2D chromatogram.
+    The modulations start offset points into the signal, these points are skipped while reading. The number of modulations does not depend
+    on the offset, the points missing at the end of the shifted last modulation are set to 0.
+    offset='auto' estimates the offset with estimate_shift (optionally against a reference chromatogram). As the phase is only known once the
+    whole signal is read, the array then holds the unshifted signal with one more modulation and the result is a shifted view into it.
+    Returns the (second retention time, modulation) array, the first row being the last point of the modulation like in convert_to2D.
+    '''
+    points_per_modulation = int(round(split_time/sampling_interval*1000))
+    n_rows = max(count_rows(filepath) - 2, 0) # first line and header
+    n_modulations = max(int(np.ceil(n_rows/points_per_modulation)) - 1, 0) # the last modulation is left out
+    skip = 0 if offset == 'auto' else int(offset) % points_per_modulation # points before the first modulation
+    shape = (n_modulations+1 if offset == 'auto' else n_modulations, points_per_modulation)
+    folded = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=float, shape=shape) if memmap_path is not None else np.empty(shape)
+    flat = folded.reshape(-1)
+
+    rows_read = 0
+    written = 0
+    start_time = None
+    for chunk in pd.read_csv(filepath, sep = ',', skiprows = 1, usecols = [1, 3], chunksize = chunksize): # Time(min) and Absolute Intensity
+        time_min = chunk.iloc[:, 0].to_numpy(dtype=float)
+        intensity = chunk.iloc[:, 1].to_numpy(dtype=float)
+        if start_time is None:
+            start_time = time_min[0]
+        begin = min(max(skip-rows_read, 0), len(intensity)) # rows of this chunk before the first modulation
+        position = rows_read + begin - skip
+        n = max(min(len(intensity)-begin, len(flat)-position), 0)
+        target = flat[position:position+n]
+        target[:] = intensity[begin:begin+n]
+        target[(time_min[begin:begin+n]-start_time)*60 <= solvent_time] = 0
+        rows_read += len(intensity)
+        written = max(written, position+n)
+    flat[written:] = 0 # end of the shifted last modulation
+
+    n_modulations = min(n_modulations, max(int(np.ceil(rows_read/points_per_modulation)) - 1, 0)) # in case of blank lines at the end
+    if offset == 'auto' and n_modulations:
+        offset = estimate_shift(folded[:n_modulations].T[::-1], reference)
+        return flat[offset:offset+n_modulations*points_per_modulation].reshape(n_modulations, points_per_modulation).T[::-1]
+    return folded[:n_modulations].T[::-1]
+
 def split_solvent(df: pd.DataFrame, solvent_time: float)->pd.DataFrame:
     '''sets absolute intensity to 0 when time is < solvent_time'''
     df.loc[df['Ret.Time[s]'] <= solvent_time, 'Absolute Intensity'] = 0
@@ -31,8 +88,12 @@ def add_split(df,split_time,sampling_interval):#split time in s, sampling interv
     The function will add rows to the dataframe if the last modulation is not complete.'''
     rows_splitting = split_time/sampling_interval*1000
     df['split_no_fromindex'] = df.index//rows_splitting 
-    while len(df[df['split_no_fromindex']==df['split_no_fromindex'].max()]) < len(df[df['split_no_fromindex']==df['split_no_fromindex'].min()]):
-        df.loc[len(df)+1] = df.iloc[-1]
+    split_no = df['split_no_fromindex'].to_numpy()
+    missing = np.searchsorted(split_no, split_no[0], side='right') - (len(split_no) - np.searchsorted(split_no, split_no[-1])) # size of the first minus the last modulation
+    if missing > 0: # the last row is repeated to complete the last modulation, all at once
+        padding = df.iloc[[-1]*missing]
+        padding.index = range(len(df)+1, len(df)+1+missing)
+        df = pd.concat([df, padding])
     return df
 
 def min_correct(df): # 'global minimum' as baseline
@@ -43,29 +104,24 @@ def baseline_stridewise(df_array): #minimum in each stride as baseline
     df_array = df_array - df_array.min(axis=0)
     return df_array
 
-def convert_to2D(df,split_time):
-    df_short = df[['split_no_fromindex','Absolute Intensity']]
-    array_list = []
-    
-    for i in range(0,int(df_short['split_no_fromindex'].max())):
-        array_list.append(df_short[df_short['split_no_fromindex']==i]['Absolute Intensity'].values)
-
-    #turn arraylist into an 2D array
-    array = np.zeros((len(array_list),len(array_list[0])))
-    for i in range(0,len(array_list)):
-        array[i,:] = array_list[i]
+def fold_signal(signal, points_per_modulation, offset=0):
+    '''Returns the complete modulations of a 1D signal as a (n_modulations, points_per_modulation) view, without copying.
+    The first offset points are skipped, which shifts the phase of the modulations.
+    As in convert_to2D, the last modulation is left out, also when it is complete.'''
+    signal = np.asarray(signal)[int(offset) % points_per_modulation:]
+    n_modulations = int(np.ceil(len(signal)/points_per_modulation)) - 1
+    return signal[:n_modulations*points_per_modulation].reshape(n_modulations, points_per_modulation)
 
-    index_list_retention_time = []
-    for i in range(len(array_list)):
-        index_list_retention_time.append(i*split_time)
+def convert_to2D(df,split_time):
+    split_no = df['split_no_fromindex'].to_numpy()
+    points_per_modulation = int(np.searchsorted(split_no, split_no[0], side='right')) # modulations are consecutive blocks of rows
+    array = np.array(fold_signal(df['Absolute Intensity'].to_numpy(dtype=float), points_per_modulation)) # one copy, the frame is not changed by later steps
 
-    columns_splittime = []
-    for i in range(len(array_list[0])):
-        columns_splittime.append(round(i*split_time/len(array_list[0]),3))
+    index_list_retention_time = np.arange(array.shape[0])*split_time
+    columns_splittime = np.round(np.arange(points_per_modulation)*split_time/points_per_modulation, 3)
 
-    df_array = pd.DataFrame(array, index = index_list_retention_time, columns = columns_splittime)
-    df_array= df_array.T
-    df_array = df_array.iloc[::-1]
+    # transposed and reversed, second retention time from top to bottom
+    df_array = pd.DataFrame(array.T[::-1], index = columns_splittime[::-1], columns = index_list_retention_time)
     return df_array
 
 def shift_phase(df_array, shift):
@@ -73,6 +129,37 @@ def shift_phase(df_array, shift):
     df_array_shifted = np.roll(df_array, shift, axis=0)
     return df_array_shifted
 
+def _phase_profile(df_array):
+    # intensity summed over all modulations, in the order of the points within a modulation
+    array = np.asarray(df_array, dtype=float)
+    profile = array.sum(axis=1) if array.ndim == 2 else array
+    return profile[::-1]
+
+def estimate_shift(df_array, reference=None, window=None)->int:
+    '''
+    Estimates the phase shift of a 2D chromatogram (as from convert_to2D) with one FFT-based circular cross-correlation.
+    Without a reference, the modulations are cut where the intensity summed over all modulations is lowest (moving average over window points,
+    default 1% of a modulation), so as few peaks as possible wrap around. With a reference 2D chromatogram (or its row sums) of the same
+    modulation length, the shift that best matches its phase is returned.
+    The shift s can be applied with shift_phase(df_array, s) or, without a copy, as offset in fold_signal or read_chromatogram_2D.
+    These are not identical: shift_phase wraps the first s points of each modulation around to its end, while the offset moves the
+    modulation boundaries in the signal, so these points are taken from the start of the next modulation. At the end of the signal,
+    read_chromatogram_2D sets them to 0 and keeps the number of modulations, fold_signal leaves the incomplete last modulation out.
+    '''
+    profile = _phase_profile(df_array)
+    n = len(profile)
+    if reference is None:
+        window = window or max(n//100, 1)
+        kernel = np.zeros(n)
+        kernel[:window] = 1/window
+        smoothed = np.fft.irfft(np.fft.rfft(profile)*np.fft.rfft(kernel), n) # trailing moving average, circular
+        return int((np.argmin(smoothed) - (window-1)//2) % n)
+    reference_profile = _phase_profile(reference)
+    if len(reference_profile) != n:
+        raise ValueError('The reference has {} points per modulation, the chromatogram {}'.format(len(reference_profile), n))
+    correlation = np.fft.irfft(np.conj(np.fft.rfft(reference_profile))*np.fft.rfft(profile), n)
+    return int(np.argmax(correlation))
+
 import tifffile
 
 
@@ -96,42 +183,135 @@ def integrate_masked(df_norm_array, maskpath):
     
 
 
+def trapezoid_weights(n):
+    '''weights w with np.sum(w*y) equal to integrate.trapezoid(y) for unit spacing'''
+    weights = np.ones(n)
+    if n:
+        weights[[0, -1]] = 0.5 if n > 1 else 0
+    return weights
+
+
+class GCGC_masks:
+    '''
+    All masks of a mask directory, read once and stacked into a (masks, rows, columns) array.
+    The double trapezoid integration of a chromatogram times each mask is done in a single contraction with precomputed weights.
+    Use load_masks(mask_dir) to reuse the masks across calls.
+    '''
+    def __init__(self, mask_dir):
+        self.mask_dir = mask_dir
+        self.paths = glob.glob(mask_dir + '*.tif')
+        self.names = [os.path.basename(path).split('.')[0].split('Mask_')[-1] for path in self.paths]
+        self.masks = np.stack([tifffile.imread(path)/255 for path in self.paths]) if self.paths else np.zeros((0, 0, 0)) # if the mask is binary no need to divide by 255
+        self.weights = np.outer(trapezoid_weights(self.masks.shape[1]), trapezoid_weights(self.masks.shape[2]))
+
+    def integrate(self, arrays):
+        '''Integrals of one (rows, columns) or many (n, rows, columns) chromatograms in each mask, shape (masks,) or (n, masks)'''
+        arrays = np.asarray(arrays, dtype=float)
+        if not self.paths:
+            return np.zeros(arrays.shape[:-2] + (0,))
+        if arrays.shape[-2:] != self.masks.shape[1:]:
+            raise ValueError('Chromatogram shape {} does not match the mask shape {}'.format(arrays.shape[-2:], self.masks.shape[1:]))
+        weighted = (arrays*self.weights).reshape(arrays.shape[:-2] + (-1,))
+        return weighted @ self.masks.reshape(len(self.masks), -1).T
+
+    def integral_frame(self, arrays):
+        '''Integrals as a frame with one row per chromatogram, the remaining chromatogram volume is left as unassigned.'''
+        integrals = np.atleast_2d(self.integrate(arrays))
+        df_integral = pd.DataFrame(integrals, columns = self.names)
+        df_integral['unassigned'] = 1-integrals.sum(axis=1)
+        return df_integral
+
+
+_mask_cache = {}
+
+def load_masks(mask_dir) -> GCGC_masks:
+    '''Returns the masks of mask_dir, only read from disk again when the .tif files change.'''
+    paths = glob.glob(mask_dir + '*.tif')
+    stamp = tuple((path, os.path.getmtime(path)) for path in paths)
+    cached = _mask_cache.get(mask_dir)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, GCGC_masks(mask_dir))
+        _mask_cache[mask_dir] = cached
+    return cached[1]
+
+
 def mask_integrate(df_array_norm, mask_dir) -> pd.DataFrame:
     '''
     Returns a frame consisting of a the integrals for each mask.
     Masks are a 2D array of the same size as the 2D chromatogram. The mask is a binary image where the areas of interest is 255 and the rest is 0.
     The chromatogram is multiplied by each mask individually, followed by an integration.
-    To adjust, change the masks in the mask_dir folder.
+    To adjust, change the masks in the mask_dir folder. mask_dir can also be a GCGC_masks instance.
     '''
-    mask_list = glob.glob(mask_dir + '*.tif') #
-    mask_names = []
-    for i in range(len(mask_list)):
-        mask_name = mask_list[i].split('\\')[-1].split('.')[0]
-        mask_names.append(mask_name.split('Mask_')[-1])
-
-    integral_list = []
-    for i in range(len(mask_list)):
-        integral_list.append(integrate_masked(df_array_norm, mask_list[i]))
-
-    df_integral = pd.DataFrame([integral_list], columns = mask_names)
-    df_integral['unassigned'] = 1-df_integral[mask_names].sum(axis=1) # the remaining chromatogram volume is left as unassigned.
-    return df_integral
-
-def process_chromatogram(filepath, split_time: float, sampling_interval: float, mask_dir,shift: float =0, solvent_time: float =0)->pd.DataFrame:
-    df = parse_chromatogram(filepath)
-    df = split_solvent(df, solvent_time)
-    df = add_split(df,split_time,sampling_interval)
-    df_array = convert_to2D(df,split_time)
-    df_array = baseline_stridewise(df_array)
-    df_array = shift_phase(df_array, shift)
+    masks = mask_dir if isinstance(mask_dir, GCGC_masks) else load_masks(mask_dir)
+    return masks.integral_frame(df_array_norm)
+
+def process_chromatogram(filepath, split_time: float, sampling_interval: float, mask_dir,shift: float =0, solvent_time: float =0, reference=None)->pd.DataFrame:
+    # shift='auto' estimates the phase (see estimate_shift) and applies it while folding instead of rolling the array
+    if shift == 'auto':
+        df_array = read_chromatogram_2D(filepath, split_time, sampling_interval, solvent_time, offset='auto', reference=reference)
+        df_array = baseline_stridewise(df_array)
+    else:
+        df_array = read_chromatogram_2D(filepath, split_time, sampling_interval, solvent_time)
+        df_array = baseline_stridewise(df_array)
+        df_array = shift_phase(df_array, shift)
     df_array_norm = normalize_array(df_array)
     df_integral = mask_integrate(df_array_norm, mask_dir)
     return df_integral, df_array_norm
 
 
+_worker_masks = None
+
+def _init_worker(mask_dir):
+    # every worker process reads the masks once
+    global _worker_masks
+    _worker_masks = mask_dir if isinstance(mask_dir, GCGC_masks) else load_masks(mask_dir)
+
+def output_names(filepaths):
+    '''Names of the saved 2D chromatograms: the path of each file relative to the directory shared by all files, without extension and with / replaced by _.
+    For files in one directory this is the filename, files with the same name in different directories get different names.'''
+    paths = [os.path.abspath(filepath) for filepath in filepaths]
+    if not paths:
+        return []
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, '_') for path in paths]
+
+def _process_file(filepath, split_time, sampling_interval, shift, solvent_time, output_path, reference):
+    df_integral, df_array_norm = process_chromatogram(filepath, split_time, sampling_interval, _worker_masks, shift, solvent_time, reference)
+    if output_path is not None:
+        np.save(output_path, np.asarray(df_array_norm))
+    return df_integral
+
+def process_batch(filepaths, split_time: float, sampling_interval: float, mask_dir, shift: float =0, solvent_time: float =0, max_workers=None, output_directory=None, reference=None)->pd.DataFrame:
+    '''
+    Runs process_chromatogram for a list of GCxGC files in a process pool, the masks are read once per worker.
+    Returns the integrals of all files as one frame indexed by the file path.
+    With an output_directory, the normalized 2D chromatograms are saved there as <name>.npy, see output_names.
+    max_workers=1 processes the files in this process.
+    '''
+    if output_directory is not None:
+        os.makedirs(output_directory, exist_ok=True)
+        output_paths = [os.path.join(output_directory, name+'.npy') for name in output_names(filepaths)]
+        if len(set(output_paths)) < len(output_paths):
+            raise ValueError('Some files would be saved to the same .npy file, every file can only be processed once')
+    else:
+        output_paths = [None]*len(filepaths)
+    arguments = [(filepath, split_time, sampling_interval, shift, solvent_time, output_path, reference) for filepath, output_path in zip(filepaths, output_paths)]
+    if max_workers == 1 or len(filepaths) < 2:
+        _init_worker(mask_dir)
+        integrals = [_process_file(*argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(mask_dir,)) as executor:
+            integrals = list(executor.map(_process_file, *zip(*arguments)))
+    if not integrals:
+        return pd.DataFrame()
+    df_integrals = pd.concat(integrals, ignore_index=True)
+    df_integrals.index = list(filepaths)
+    return df_integrals
+
+
 
 def plot_2Dchromatogram(df_array_norm,maskdir,savedir,plotmask=True,title = '2D Chromatogram',split_time = 20):
-    mask_list = glob.glob(maskdir + '*.tif')
+    masks = maskdir if isinstance(maskdir, GCGC_masks) else load_masks(maskdir)
     plt.figure(figsize=(8,8/1.615))
     plt.imshow(np.sqrt(df_array_norm), cmap='viridis', interpolation='nearest', extent=[0, 106, 0, split_time], aspect='auto')
     plt.colorbar(label='$\sqrt{\mathrm{intensity}}$')
@@ -139,8 +319,7 @@ def plot_2Dchromatogram(df_array_norm,maskdir,savedir,plotmask=True,title = '2D
     colormaplist = [matplotlib.colors.ListedColormap(['none', 'C'+str(i)]) for i in range(6) ]
     annotations = [['Alkanes/Alkenes',28,7],['Monoaromatics',45,12],['Diaromatics',30,19],['Triaromatics',64,4.5],['Pyrenes',93,8]]
     if plotmask:
-        for i in range(len(mask_list)):
-            mask =  tifffile.imread(mask_list[i])/255 # if the mask is binary no need to divide by 255
+        for i, mask in enumerate(masks.masks):
             plt.imshow(mask, cmap=colormaplist[i], interpolation='nearest', extent=[0, 106, 0, split_time], aspect='auto', alpha=0.2)
             plt.text(annotations[i][1], annotations[i][2], annotations[i][0], fontsize=8, color='white')
 
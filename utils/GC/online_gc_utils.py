@@ -1,7 +1,10 @@
 import pandas as pd
-import datetime
-from scipy import integrate
+import numpy as np
+import io
 import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from utils.misc import file_cache, time_alignment
 
 
 def get_water_content(TGA_file):
@@ -18,84 +21,144 @@ def get_water_content(TGA_file):
 
 
 
-def read_chromatogram(Path):
-    #Reads the ascii file of the injection. Splits in into a metadate frame and a frame containing chromatograms of the 3 channels.
-    #Sampling frequency must be equal for all channels.
-
-    df_chromatogram = pd.read_csv(Path, sep='\t', header=None,skiprows=13)
-    df_chromatogram_meta = pd.read_csv(Path, sep='\t', header=None,skiprows=0,nrows=13)
-
-    #split the chromatogram into the different columns. This is achieved by splitting the frame at indexes matching 1/3 and 2/3 of the lenght
-    df_Channel_1 = df_chromatogram.iloc[0:int(len(df_chromatogram)/3)].reset_index(drop=True)
-    df_Channel_2 = df_chromatogram.iloc[int(len(df_chromatogram)/3):int(2*len(df_chromatogram)/3)].reset_index(drop=True)
-    df_Channel_3 = df_chromatogram.iloc[int(2*len(df_chromatogram)/3):len(df_chromatogram)].reset_index(drop=True)
+chromatogram_columns = ['FID_L','FID_M','TCD']
+parser_version = 2 # increase when read_injection changes, invalidates cached injections
 
-    #combine the 3 Channels into one frame, new index
-    df_chromatogram = pd.concat([df_Channel_1,df_Channel_2,df_Channel_3],axis=1)
-    sampling_freqs = [float(df_chromatogram_meta.iloc[7][0].split(',')[i]) for i in range(1,4)]
+def read_injection(Path):
+    '''
+    Reads the ascii file of an injection in one pass.
+    Returns the chromatograms of the 3 channels as a (3, n) array, the sampling interval (s), the injection timestamp and the 13 header lines.
+    The channels are stored one after the other, the block is split at 1/3 and 2/3 of its length. Sampling frequency must be equal for all channels.
+    '''
+    with open(Path) as f:
+        header = [f.readline().rstrip('\n') for i in range(13)]
+        body = f.read()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(body, sep=' ') # C-speed, one number per line
+        except (ValueError, DeprecationWarning): # text that is not a number
+            values = None
+    # fromstring stops at the first value it cannot parse and skips empty lines, the values are only taken if there is one for every line
+    n_lines = body.rstrip('\r\n').count('\n')+1 if body.strip() else 0
+    if values is None or len(values) != n_lines:
+        values = pd.read_csv(io.StringIO(body), sep='\t', header=None).iloc[:, 0].to_numpy(dtype=float)
+    n = len(values)
+    bounds = [0, int(n/3), int(2*n/3), n]
+    if n % 3 == 0:
+        signals = values.reshape(3, n//3)
+    else: # uneven channels are padded with NaN
+        signals = np.full((3, max(np.diff(bounds))), np.nan)
+        for i in range(3):
+            signals[i, :bounds[i+1]-bounds[i]] = values[bounds[i]:bounds[i+1]]
+
+    sampling_freqs = [float(header[7].split('\t')[0].split(',')[i]) for i in range(1,4)]
     if len(set(sampling_freqs)) != 1:
         raise ValueError('The sampling frequencies are not equal')
+    sampling_interval = 1/sampling_freqs[0] # s
+    timestamp = pd.to_datetime(header[6].split('\t')[0].split(',')[1])
+    return signals, sampling_interval, timestamp, header
+
 
-    sampling_freq = 1/sampling_freqs[0] #Hz
+def load_injection(Path, cache_dir=None):
+    # read_injection, cached as binary in cache_dir (see utils.misc.file_cache) if given
+    if cache_dir is None:
+        return read_injection(Path)
+    key = file_cache.cache_key(Path, 'online_gc_utils.read_injection {}'.format(parser_version))
+    cached = file_cache.load(key, cache_dir)
+    if cached is not None:
+        arrays, meta = cached
+        return arrays['signals'], meta['sampling_interval'], pd.Timestamp(meta['timestamp']), meta['header']
+    signals, sampling_interval, timestamp, header = read_injection(Path)
+    file_cache.store(key, {'signals': signals}, meta={'sampling_interval': sampling_interval, 'timestamp': timestamp.isoformat(), 'header': header}, sources=Path, cache_dir=cache_dir)
+    return signals, sampling_interval, timestamp, header
 
-    df_chromatogram['Time[s]'] = df_chromatogram.index*sampling_freq
-    #set time as index
-    df_chromatogram = df_chromatogram.set_index('Time[s]')
-    df_chromatogram.columns = ['FID_L','FID_M','TCD']
+
+def read_chromatogram(Path):
+    #Reads the ascii file of the injection. Splits in into a metadate frame and a frame containing chromatograms of the 3 channels.
+    #Sampling frequency must be equal for all channels.
+    signals, sampling_interval, timestamp, header = read_injection(Path)
+    df_chromatogram_meta = pd.DataFrame([line.split('\t') for line in header])
+    time = pd.Index(np.arange(signals.shape[1])*sampling_interval, name='Time[s]')
+    df_chromatogram = pd.DataFrame(signals.T, index=time, columns=chromatogram_columns)
     return df_chromatogram, df_chromatogram_meta
 
 
 
 
+baseline_rows = [slice(288*50, 294*50), slice(288*50, 294*50), slice(10*50, 15*50)] # flat regions of FID_L, FID_M and TCD (rows, sampled at 50 Hz)
+
 def baseline_correct(frame):
-    #for each channel, substract the minimum value
-    for i in range(0,3):
-        #substract the mean of the values between 288 and 294 seconds
-        frame.iloc[:,0] = frame.iloc[:,0] - frame.iloc[288*50:294*50,0].mean()
-        frame.iloc[:,1] = frame.iloc[:,1] - frame.iloc[288*50:294*50,1].mean()
-        frame.iloc[:,2] = frame.iloc[:,2] - frame.iloc[10*50:15*50,2].mean()
-        # frame.iloc[:,i] = frame.iloc[:,i] - frame.iloc[:,i].min()
+    #for each channel, substract the mean of a flat region of the chromatogram
+    for i, rows in enumerate(baseline_rows):
+        frame.iloc[:,i] -= frame.iloc[rows,i].mean()
     return frame
 
+def baseline_correct_array(signals):
+    #same as baseline_correct for a (3, n) array, in place
+    for i, rows in enumerate(baseline_rows):
+        signals[i] -= np.nanmean(signals[i, rows])
+    return signals
 
 
 
-def integrate_peaks(frame, Peaks_channel2,Peaks_TCD,Peaks_channel1):
-    df = frame['FID_M'] #only look into second channel
-    integrals_list = []
-    for i in range(0,len(Peaks_channel2)):
-        #ideantify peaks and valleys in the range of the peak
-        integral = integrate.trapezoid(df[(df.index > Peaks_channel2[i][1][0]) & (df.index < Peaks_channel2[i][1][1])])
-        integrals_list.append(integral)
-    df_TCD = frame['TCD']
-    for i in range(0,len(Peaks_TCD)):
-        integral = integrate.trapezoid(df_TCD[(df_TCD.index > Peaks_TCD[i][1][0]) & (df_TCD.index < Peaks_TCD[i][1][1])])
-        integrals_list.append(integral)
 
-    df_FIDL = frame['FID_L']
-    for i in range(0,len(Peaks_channel1)):
-        integral = integrate.trapezoid(df_FIDL[(df_FIDL.index > Peaks_channel1[i][1][0]) & (df_FIDL.index < Peaks_channel1[i][1][1])])
-        integrals_list.append(integral)
+def peak_windows(time, Peaks_channel2, Peaks_TCD, Peaks_channel1):
+    '''
+    Start and stop index of every peak on the time axis (points strictly inside the peak boundaries), and the channel it is integrated in
+    (column of the chromatogram frame: 0 FID_L, 1 FID_M, 2 TCD). Peaks are in the order of get_peaknames.
+    '''
+    peaks = list(Peaks_channel2) + list(Peaks_TCD) + list(Peaks_channel1)
+    channels = np.array([1]*len(Peaks_channel2) + [2]*len(Peaks_TCD) + [0]*len(Peaks_channel1), dtype=int)
+    bounds = np.array([peak[1] for peak in peaks], dtype=float).reshape(-1, 2)
+    starts = np.searchsorted(time, bounds[:,0], side='right')
+    stops = np.searchsorted(time, bounds[:,1], side='left')
+    return channels, starts, np.maximum(stops, starts)
 
 
-    return integrals_list
+def integrate_windows(signals, channels, starts, stops):
+    '''
+    Trapezoid integrals (unit spacing, like integrate.trapezoid without x) of signals[channel, start:stop] for all peaks at once.
+    signals is a (channels, points) array, the integrals follow from one cumulative sum per channel.
+    '''
+    signals = np.asarray(signals, dtype=float)
+    cumulative = np.zeros((signals.shape[0], signals.shape[1]+1))
+    np.cumsum(signals, axis=1, out=cumulative[:,1:])
+    first = signals[channels, np.minimum(starts, signals.shape[1]-1)]
+    last = signals[channels, np.maximum(stops-1, 0)]
+    integrals = cumulative[channels, stops] - cumulative[channels, starts] - 0.5*(first + last)
+    integrals[stops - starts < 2] = 0 # a single point has no area
+    return integrals
 
 
+def integrate_peaks(frame, Peaks_channel2,Peaks_TCD,Peaks_channel1, windows=None):
+    # windows from peak_windows can be passed to reuse them for chromatograms with the same time axis
+    if windows is None:
+        windows = peak_windows(frame.index.to_numpy(), Peaks_channel2, Peaks_TCD, Peaks_channel1)
+    signals = frame[['FID_L','FID_M','TCD']].to_numpy(dtype=float).T
+    return list(integrate_windows(signals, *windows))
 
 
 
-def parse_log(logfile_path):
-    Log = pd.read_csv(logfile_path, sep='\t', skiprows=1)
-    Log = Log[['Date','Time','MFC 1 pv','MFC 2 pv','MFC 3 pv','MFC 4 pv', 'Oven Temperature','v11-reactor','v10-bubbler','v12-gc']]
+
+
+log_columns = ['Date','Time','MFC 1 pv','MFC 2 pv','MFC 3 pv','MFC 4 pv', 'Oven Temperature','v11-reactor','v10-bubbler','v12-gc']
+
+def format_log(Log):
+    # selects and renames the columns of the labview log and adds the timestamp
+    Log = Log[log_columns].copy()
     # for the v-11 reactor columns, replace all 0 with 'reactor' else 'bypass'
-    Log['v11-reactor'] = Log['v11-reactor'].apply(lambda x: 'reactor' if x == 0 else 'bypass')
+    Log['v11-reactor'] = np.where(Log['v11-reactor'] == 0, 'reactor', 'bypass')
     Log.rename(columns={'MFC 1 pv':'N2_flow'}, inplace=True)
     Log.rename(columns={'MFC 4 pv':'He_Bubbler'}, inplace=True)
     Log.rename(columns={'MFC 3 pv':'He_Dilution'}, inplace=True)
     Log['timestamp'] = pd.to_datetime(Log['Date'] + ' ' + Log['Time'],format='%m/%d/%Y %I:%M:%S %p')
-    Log['timestamp'] = Log.apply(lambda row: datetime.datetime.strptime(row['Date'] + ' ' + row['Time'], '%m/%d/%Y %I:%M:%S %p'), axis=1)
     return Log
 
+def parse_log(logfile_path):
+    Log = pd.read_csv(logfile_path, sep='\t', skiprows=1)
+    return format_log(Log)
+
 
 def get_peaknames(Peaks_channel1,Peaks_channel2,Peaks_TCD):
     Peaknames=[Peaks_channel2[i][0] for i in range(0,len(Peaks_channel2))]
@@ -113,19 +176,44 @@ def get_chrom_paths(chromdir,chromatogram_list):
         Paths.append(os.path.normpath(chromdir + chromatogram_list[i]))
     return Paths
 
-def process_chromatograms(Paths,Peaknames,Peaks_channel2,Peaks_TCD,Peaks_channel1):
+def integrate_injection(Path, Peaks_channel2, Peaks_TCD, Peaks_channel1, cache_dir=None, windows=None):
+    # peak integrals (in the order of get_peaknames) and timestamp of a single injection
+    # windows is a dictionary of peak_windows by (number of points, sampling interval), new time axes are added to it
+    signals, sampling_interval, timestamp, header = load_injection(Path, cache_dir)
+    signals = baseline_correct_array(np.array(signals)) # Baseline is the mean of a flat reagion in the chromatogram
+    if windows is None:
+        windows = {}
+    axis = (signals.shape[1], sampling_interval)
+    if axis not in windows:
+        windows[axis] = peak_windows(np.arange(signals.shape[1])*sampling_interval, Peaks_channel2, Peaks_TCD, Peaks_channel1)
+    return integrate_windows(signals, *windows[axis]), timestamp
+
+def process_chromatograms(Paths,Peaknames,Peaks_channel2,Peaks_TCD,Peaks_channel1, max_workers=1, cache_dir=None):
     '''
     Reads in the chromatogram, baseline corrects it and integrates the peaks specified by the peak lists.
     Returns a frame with the peak integrals and injection timestamp
+    The injections are processed one after the other, or in a process pool with max_workers processes (None for one per CPU).
+    Parsed injections are cached in cache_dir if given.
+    The peak windows are found once on the time axis of the first injection and reused for all injections with the same time axis.
     '''
-    Integral_Frame = pd.DataFrame(columns=Peaknames)
-
-    for i in range(0,len(Paths)):
-        df_chromatogram, df_chromatogram_meta = read_chromatogram(Paths[i])
-        df_chromatogram = baseline_correct(df_chromatogram) # Baseline is the mean of a flat reagion in the chromatogram
-        result_frame = integrate_peaks(df_chromatogram, Peaks_channel2,Peaks_TCD,Peaks_channel1)
-        result_frame.append(pd.to_datetime(df_chromatogram_meta.iloc[6][0].split(',')[1]))
-        Integral_Frame.loc[i] = result_frame
+    n_peaks = len(Peaks_channel2) + len(Peaks_TCD) + len(Peaks_channel1)
+    windows = {} # filled by the first injection, the workers get a copy
+    arguments = [(Path, Peaks_channel2, Peaks_TCD, Peaks_channel1, cache_dir, windows) for Path in Paths]
+    if max_workers == 1 or len(Paths) < 2:
+        results = [integrate_injection(*argument) for argument in arguments]
+    else:
+        results = [integrate_injection(*arguments[0])]
+        chunksize = max(1, len(Paths)//(4*(max_workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results += list(executor.map(integrate_injection, *zip(*arguments[1:]), chunksize=chunksize))
+
+    integrals = np.empty((len(Paths), n_peaks)) # one row per injection
+    timestamps = []
+    for i, (integral, timestamp) in enumerate(results):
+        integrals[i] = integral
+        timestamps.append(timestamp)
+    Integral_Frame = pd.DataFrame(integrals, columns=Peaknames[:n_peaks])
+    Integral_Frame[Peaknames[n_peaks]] = pd.to_datetime(timestamps) if timestamps else pd.Series(dtype='datetime64[ns]')
     return Integral_Frame
 
 
@@ -133,12 +221,9 @@ def process_chromatograms(Paths,Peaknames,Peaks_channel2,Peaks_TCD,Peaks_channel
 def get_temp_and_valves(Integral_Frame,Log):
     '''
     Gets the temperature and bubbler/bypass valves from the logfile.
-    At the timestamp of the injection, look in the log file for the position of the valves and the temperature
+    At the timestamp of the injection, look in the log file for the position of the valves and the temperature (closest log entry)
     '''
-    Integral_Frame['Temperature'] = Integral_Frame['Timestamp'].apply(lambda x: Log['Oven Temperature'][Log['timestamp'].sub(x).abs().idxmin()])
-    Integral_Frame['v10-bubbler'] = Integral_Frame['Timestamp'].apply(lambda x: Log['v10-bubbler'][Log['timestamp'].sub(x).abs().idxmin()])
-    Integral_Frame['v11-reactor'] = Integral_Frame['Timestamp'].apply(lambda x: Log['v11-reactor'][Log['timestamp'].sub(x).abs().idxmin()])
-    return Integral_Frame
+    return time_alignment.attach_log(Integral_Frame, Log, {'Oven Temperature': 'Temperature', 'v10-bubbler': 'v10-bubbler', 'v11-reactor': 'v11-reactor'})
 
 
 
@@ -158,5 +243,69 @@ def get_mean_product(Arrhenius_Frame, Temperature):
 
 
 
+def normalize_integrals(Integral_Frame, no_chromatograms_norm = 5):
+    '''
+    Relative DMP and product peak areas of a DMP cracking experiment (Integral_Frame with temperature and valves, see get_temp_and_valves).
+    The experiment starts when the flow over the bubbler is started. The mean DMP peak area of the last no_chromatograms_norm chromatograms
+    before switching from bypass to reactor is the starting concentration, N2 is used as internal standard.
+    Returns the frame and the starting DMP peak area.
+    '''
+    Integral_Frame = Integral_Frame.sort_values(by=['Timestamp'])
+    Integral_Frame = Integral_Frame[Integral_Frame['v10-bubbler'] == 1].copy()
+    Integral_Frame['Timestamp_0'] = (Integral_Frame['Timestamp'] - Integral_Frame['Timestamp'].iloc[0]).dt.total_seconds()/60
+    Integral_Frame = Integral_Frame.iloc[:-1,:] # the last chromatogram is dropped
+
+    idx = Integral_Frame[Integral_Frame['v11-reactor'] == 'bypass'].index
+    idx_norm = idx[-(no_chromatograms_norm+1):-1]
+    A0_DMP = Integral_Frame['DMP_L'][idx_norm].mean()
+    Integral_Frame['N2corr'] = Integral_Frame['N2']/Integral_Frame.loc[idx_norm]['N2'].mean()
+    Integral_Frame['DMP_norm'] = Integral_Frame['DMP_L']/A0_DMP*100/Integral_Frame['N2corr']
+    Integral_Frame['Products_norm'] = Integral_Frame['Rest']/A0_DMP*100/Integral_Frame['N2corr']
+    return Integral_Frame, A0_DMP
+
+
+def DMP_molar_flow(A0_DMP):
+    #molar flow of DMP (mol/s) estimated from the starting peak area, calibration of september 1st 2023
+    vol_pct = A0_DMP*2.6752713006562702e-09/7
+    volumetric_flow = (50+1.5)/60*10**(-6) # 1.5 ml/min N2 through the bubbler, diluted by 50 ml/min He, in m3/s
+    temp_heattracing = 125 + 273.13 # temperature at which the gas enters the GC
+    return vol_pct*10**5*volumetric_flow/(8.314*temp_heattracing)
+
+
+def get_arrhenius_frame(Integral_Frame, cat_mass_dry, molar_flow, n_temperatures = 4):
+    '''
+    Rate constants at the n_temperatures most common temperatures of a normalized Integral_Frame (see normalize_integrals),
+    from the mean conversion at each temperature. Only chromatograms with more than 0.5% products are used, which skips the bypass period.
+    '''
+    temps = Integral_Frame['Temperature'].value_counts().index[0:n_temperatures]
+    Arrhenius_integrals = Integral_Frame[Integral_Frame['Products_norm']>0.5]
+    DMP_left_list = [get_mean_DMP(Arrhenius_integrals, temp) for temp in temps]
+    product_yields = [get_mean_product(Arrhenius_integrals, temp) for temp in temps]
+
+    Arrhenius_frame = pd.DataFrame({'Temperature(K)':temps+273.13,'DMP_norm':DMP_left_list,'Product_yield':product_yields})
+    Arrhenius_frame['deviation from 100%'] = Arrhenius_frame['DMP_norm']+Arrhenius_frame['Product_yield'] # mass balance, corrected for
+    Arrhenius_frame['1/T'] = 1/Arrhenius_frame['Temperature(K)']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Arrhenius_frame['ln(k)_conversion'] = np.log(-np.log(Arrhenius_frame['DMP_norm']/Arrhenius_frame['deviation from 100%'])/cat_mass_dry*molar_flow)
+        Arrhenius_frame['ln(k)_product'] = np.log(-np.log(1-Arrhenius_frame['Product_yield']/Arrhenius_frame['deviation from 100%'])/cat_mass_dry*molar_flow)
+    return Arrhenius_frame
+
+
+def fit_arrhenius(Arrhenius_frame, column = 'ln(k)_product'):
+    '''Linear fit of ln(k) over 1/T, returns Ea (kJ/mol), lnA with their errors and the covariance of (slope, intercept)'''
+    frame = Arrhenius_frame[np.isfinite(Arrhenius_frame[column])]
+    X = np.column_stack([frame['1/T'].to_numpy(dtype=float), np.ones(len(frame))])
+    y = frame[column].to_numpy(dtype=float)
+    if len(y) < 2:
+        return {'Ea': np.nan, 'Ea_error': np.nan, 'lnA': np.nan, 'lnA_error': np.nan, 'A': np.nan, 'pcov': np.full((2, 2), np.nan)}
+    (slope, intercept), *rest = np.linalg.lstsq(X, y, rcond=None)
+    dof = len(y) - 2
+    s2 = np.sum((y - X @ [slope, intercept])**2)/dof if dof > 0 else np.inf
+    pcov = s2*np.linalg.pinv(X.T @ X)
+    std_err, intercept_stderr = np.sqrt(np.diag(pcov))
+    return {'Ea': slope*-8.314/1000, 'Ea_error': std_err*8.314/1000, 'lnA': intercept, 'lnA_error': intercept_stderr, 'A': np.exp(intercept), 'pcov': pcov}
+
+
+
 
 
@@ -2,6 +2,9 @@ import pandas as pd
 import numpy as np
 from scipy import integrate
 import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from utils.GC import gcgc_utils
 def get_meta(dir_path):
     meta_frame = pd.read_csv(filepath_or_buffer=dir_path+'meta.csv', sep=',',index_col=0,
                             skip_blank_lines=True, names=['item','value'],
@@ -39,16 +42,89 @@ def get_calib_factors(meta_frame):
     return calib_factors
 
 
+def peak_labels(peaks):
+    # names of the integrals of a peak list, FID peak lists (without baseline_point) get the total chromatogram as well
+    if 'baseline_point' in peaks.columns:
+        return peaks.index.to_list()
+    return peaks.index.to_list() + ['total']
+
+
+class PeakTable:
+    '''
+    Peak list compiled for the time axis of a detector: the integration windows (points strictly between lower_bound and upper_bound) are converted to index ranges once.
+    If the peak list has a column baseline_point (TCD), the value at this time is subtracted as baseline of each peak.
+    Otherwise (FID) the minimum of the chromatogram is the baseline and an integral of the total chromatogram is added.
+    integrate() integrates a whole stack of chromatograms, one row per file, from the cumulative trapezoid of each row.
+    '''
+    def __init__(self, peaks, time):
+        self.time = np.asarray(time, dtype=float)
+        if np.any(np.diff(self.time) <= 0):
+            raise ValueError('The time axis is not increasing')
+        self.labels = peak_labels(peaks)
+        starts = np.searchsorted(self.time, peaks['lower_bound'].to_numpy(dtype=float), side='right')
+        stops = np.searchsorted(self.time, peaks['upper_bound'].to_numpy(dtype=float), side='left')
+        # windows with less than 2 points (also those past the end of the time axis) get start == last, i.e. no area and no width
+        self.starts = np.minimum(starts, len(self.time)-1)
+        self.lasts = np.where(stops-starts < 2, self.starts, stops-1) # last point of the window
+        self.widths = self.time[self.lasts] - self.time[self.starts]
+        self.point_baseline = 'baseline_point' in peaks.columns
+        if self.point_baseline:
+            self.baseline_points = np.array([pd.Index(self.time).get_loc(point) for point in peaks['baseline_point'].to_numpy(dtype=float)])
+
+    def integrate(self, signals):
+        # integrals of a (files x points) stack as (files x peaks) array
+        signals = np.atleast_2d(np.asarray(signals, dtype=float))
+        cumulative = np.zeros(signals.shape)
+        np.cumsum(0.5*(signals[:,1:] + signals[:,:-1])*np.diff(self.time), axis=1, out=cumulative[:,1:])
+        integrals = cumulative[:,self.lasts] - cumulative[:,self.starts]
+        if self.point_baseline:
+            return integrals - signals[:,self.baseline_points]*self.widths
+        baseline = signals.min(axis=1, keepdims=True)
+        total = cumulative[:,-1:] - baseline*(self.time[-1] - self.time[0])
+        return np.hstack([integrals - baseline*self.widths, total])
+
+
+def read_chromatogram(chrom_path):
+    # time (min) and signal of a chromatogram exported by chromeleon
+    chromatogram = pd.read_csv(filepath_or_buffer=chrom_path, sep='\t', skiprows=42, thousands=r',', usecols=[0,2])
+    return chromatogram.iloc[:,0].to_numpy(dtype=float), chromatogram.iloc[:,1].to_numpy(dtype=float)
+
+
+_peaklist_cache = {}
+
+def load_peaklist(peaklist_path):
+    '''Returns the peak list csv as frame, only read from disk again when the file changes.'''
+    stamp = os.path.getmtime(peaklist_path)
+    cached = _peaklist_cache.get(peaklist_path)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, pd.read_csv(filepath_or_buffer=peaklist_path, sep=',',index_col=0))
+        _peaklist_cache[peaklist_path] = cached
+    return cached[1]
+
+
+def integrate_files(filelist, peaks):
+    '''
+    Reads the chromatograms in filelist and integrates them with the peak list (frame, see PeakTable) as a (files x peaks) array, the labels are returned as well.
+    Chromatograms with the same time axis are integrated together, the peak table is compiled once per time axis.
+    '''
+    chromatograms = [read_chromatogram(chrom_path) for chrom_path in filelist]
+    groups = {}
+    for i, (time, signal) in enumerate(chromatograms):
+        groups.setdefault(time.tobytes(), []).append(i)
+    labels = peak_labels(peaks)
+    integrals = np.empty((len(filelist), len(labels)))
+    for rows in groups.values():
+        peak_table = PeakTable(peaks, chromatograms[rows[0]][0])
+        integrals[rows] = peak_table.integrate(np.stack([chromatograms[i][1] for i in rows]))
+    return integrals, labels
+
+
 def integrate_TCD_chromatogram(chrom_path,compound_frame_TCD):
     chromatogram = pd.read_csv(filepath_or_buffer=chrom_path, sep='\t',index_col=0,skiprows=42,thousands=r',')
     chromatogram = chromatogram.drop(columns=['Step (s)'])
-    integrals = []
-    for i in compound_frame_TCD.index.to_list():
-        chrom_bl = chromatogram - chromatogram.iloc[chromatogram.index.get_loc(compound_frame_TCD['baseline_point'].loc[i])] #baseline_correction at selected point
-        x = chrom_bl.index[(chrom_bl.index > compound_frame_TCD['lower_bound'].loc[i]) & (chrom_bl.index < compound_frame_TCD['upper_bound'].loc[i])]
-        y = chrom_bl['Value (mV)'].loc[x]
-        integrals.append(integrate.trapezoid(y,x))
-    return integrals, chromatogram
+    # baseline_correction at the selected point of each compound, see PeakTable
+    integrals = PeakTable(compound_frame_TCD, chromatogram.index).integrate(chromatogram['Value (mV)'].to_numpy())[0]
+    return list(integrals), chromatogram
 
 def integrate_TCD_chromatogram_new(chrom_path,compound_frame_TCD):
     #1. Reads in a TCD chromatogram saved as .csv.
@@ -75,22 +151,27 @@ def get_TCD_flows(filepath, compound_frame_TCD):
     #Reads in the TCD chromatograms and the metafile, integrates the peaks according to the sample list and calculates the molar flow.
     
     meta_frame = get_meta(filepath)
+
+    filelist_TCD = sorted(glob.glob(filepath+'*TCD.txt*'))
+    filelist_TCD.sort(key=len)
+    #getting the integrals
+    integrals, labels = integrate_files(filelist_TCD, compound_frame_TCD)
+    TCD_frame = pd.DataFrame(integrals, columns=labels, index=[i+1 for i in range(len(filelist_TCD))])
+    return calc_TCD_flows(TCD_frame, meta_frame)
+
+
+def calc_TCD_flows(TCD_frame, meta_frame):
+    #Calculates the molar flows from the TCD integrals (one row per injection, numbered from 1 in order of the files), N2 is the internal standard.
+    #Also works for the injections recorded so far during a run.
     calib_factors = get_calib_factors(meta_frame)
     calib_factors.loc[1] = [100,100,100,100] # blank row to not mess with changing indeces all the time
-    calib_factors = calib_factors.sort_index()
+    calib_factors = calib_factors.sort_index().loc[TCD_frame.index]
 
     molar_flow = 2.018104822/50*float(meta_frame['value']['N2 flow rate: [ml/min]']) #mmol/min. 2.018 is the molar amount of N2 in 50ml at 25C and 10**5 Pa
     init = float(meta_frame['value']['GC start time:'])  # start time of filling the loops (min)
     inj_time = float(meta_frame['value']['Time sampling loop: [min]']) # time of recording of 1 injection in min
 
-    filelist_TCD = sorted(glob.glob(filepath+'*TCD.txt*'))
-    filelist_TCD.sort(key=len)
-    integral_list = []
-    #getting the integrals
-    for i in enumerate(filelist_TCD):
-        integrals, chromatogram = integrate_TCD_chromatogram(filelist_TCD[i[0]],compound_frame_TCD) 
-        integral_list.append(np.array(integrals))
-    TCD_frame = pd.DataFrame(integral_list, columns=compound_frame_TCD.index.to_list(),index=[i[0]+1 for i in enumerate(filelist_TCD)])
+    TCD_frame = TCD_frame.copy()
     #first row to nan
     TCD_frame.loc[1] = np.nan
 
@@ -123,25 +204,16 @@ def process_chromatogram(chrom_path,peaklist_path,time):
 
     baseline = chromatogram['Value (pA)'].min() # left as is to allow different baseline
     chromatogram['bl_substracted'] = chromatogram['Value (pA)'] - baseline
-    peaklist = pd.read_csv(filepath_or_buffer=peaklist_path, sep=',',index_col=0)
-    integrals = []
-    labels = peaklist.index.tolist()
-    for i in range(len(peaklist)):
-        integrals.append(integrate.trapezoid(chromatogram['bl_substracted'][(chromatogram.index>peaklist['lower_bound'].iloc[i]) & (chromatogram.index<peaklist['upper_bound'].iloc[i])],chromatogram.index[(chromatogram.index>peaklist['lower_bound'].iloc[i]) & (chromatogram.index<peaklist['upper_bound'].iloc[i])]))
-    # append an integral of the total chromatogram
-    labels.append('total')
-    integrals.append(integrate.trapezoid(chromatogram['bl_substracted'],chromatogram.index))
-    integral_frame_pA = pd.DataFrame({time: integrals}, index=labels)
+    peak_table = PeakTable(load_peaklist(peaklist_path), chromatogram.index)
+    integrals = peak_table.integrate(chromatogram['Value (pA)'].to_numpy())[0]
+    integral_frame_pA = pd.DataFrame({time: integrals}, index=peak_table.labels)
     return chromatogram, integral_frame_pA
 
 
 def get_integral_frame(filelist_FID, Peaklist_path, inj_time_timelist):
-    integral_list = []
-    for i in range(len(filelist_FID)):
-        chromatogram, integral = process_chromatogram(filelist_FID[i],Peaklist_path,inj_time_timelist[i])
-        integral_list.append(integral)
-
-    integral_frame_FID = pd.concat(integral_list, axis=1)
+    # integrals of the FID chromatograms (in pA*s), one column per injection time
+    integrals, labels = integrate_files(filelist_FID, load_peaklist(Peaklist_path))
+    integral_frame_FID = pd.DataFrame(integrals.T, index=labels, columns=inj_time_timelist[:len(filelist_FID)])
     return integral_frame_FID
 
 
@@ -150,7 +222,8 @@ def get_integral_frame(filelist_FID, Peaklist_path, inj_time_timelist):
 
 def calc_molarCflow(integral_frame_FID_pA, calib_factors, flow_frame_TCD):
     '''dividing by calibration factor and adjusting for N2 flow'''
-    integral_frame_FID_mol = integral_frame_FID_pA / np.array(calib_factors['HC_FID'])[1:]/100 * flow_frame_TCD['N2_corr']
+    # during a run only the first injections are there, the calibration factors of injection 2, 3, ... are used
+    integral_frame_FID_mol = integral_frame_FID_pA / np.array(calib_factors['HC_FID'])[1:1+integral_frame_FID_pA.shape[1]]/100 * flow_frame_TCD['N2_corr']
     return integral_frame_FID_mol.fillna(0)
 
 
@@ -210,4 +283,71 @@ def flatten_export(masses_export,cat):
     new = masses_export.drop(['molar_TCD','molar'],axis = 1)
     new.drop(['Propane','Propylene','total'], inplace=True)
     new.sum(axis=1).to_frame(name=cat).T
-    return new.sum(axis=1).to_frame(name=cat).T
\ No newline at end of file
+    return new.sum(axis=1).to_frame(name=cat).T
+
+
+
+def reduce_run(filepath, compound_frame_TCD, Peaklist_path, mask_dir, split_time=20, sampling_interval=4):
+    '''
+    Full reduction of one semibatch run directory: gas masses from the on-line GC (TCD and FID), liquid selectivities from the GCxGC chromatogram and coke from the TGA burnoff.
+    Returns the row of the mass balance table (masses in g, indexed by the catalyst code), the masses of all compounds and the carbon flows of the FID.
+    '''
+    meta_frame = get_meta(filepath)
+    catcode = meta_frame['value']['Catalyst code:']
+    calib_factors = get_calib_factors(meta_frame) # first row is ignored!
+    init = float(meta_frame['value']['GC start time:'])  # start time of filling the loops (min)
+    inj_time = float(meta_frame['value']['Time sampling loop: [min]']) # time of recording of 1 injection in min
+
+    #reading and processing TCD flows from the chromatograms
+    flow_frame_TCD = get_TCD_flows(filepath, compound_frame_TCD)
+    inj_time_timelist = [init + inj_time*i for i in range(len(flow_frame_TCD))]
+    total_masses_TCD = get_TCD_masses(flow_frame_TCD[['Propane', 'Propylene','Hydrogen']], inj_time_timelist)
+
+    #processing the FID chromatograms, the first injection is ignored
+    filelist_FID = sorted(glob.glob(filepath+'*FID_right*'))
+    filelist_FID.sort(key=len)
+    filelist_FID = filelist_FID[1:]
+    integral_frame_FID = get_integral_frame(filelist_FID, Peaklist_path, inj_time_timelist[1:]) # the integral here is in pA*s
+    integral_frame_FID_mol = calc_molarCflow(integral_frame_FID, calib_factors, flow_frame_TCD)
+    total_masses_indiv = get_indiv_integrals(integral_frame_FID_mol, inj_time_timelist)
+
+    total_coke = get_coke_amount(filepath, float(meta_frame['value']['Mass of catalyst: [g]']))
+    mass_liquid = get_liquid_yield(meta_frame)
+    GCxGCpath = glob.glob(filepath+'*GCxGC*'+'/'+'*.csv')[0]
+    liquid_selectivities = gcgc_utils.process_chromatogram(GCxGCpath, split_time, sampling_interval, mask_dir)[0]
+
+    masses_export = pd.concat([total_masses_indiv, total_masses_TCD,pd.DataFrame(data = [mass_liquid, total_coke], index=['liquid','coke'], columns=['mass']) ], axis=1)
+    export = flatten_export(masses_export, catcode)
+    # the liquid is split into the compound groups of the GCxGC
+    for j in liquid_selectivities.columns.values.tolist():
+        export[j] = export['liquid'].iloc[0]*liquid_selectivities[j].iloc[0]
+    export['coke'] = export.pop('coke')
+    export = export.drop(columns=['liquid'])
+    return export, masses_export, integral_frame_FID_mol
+
+
+def _reduce_run_row(filepath, compound_frame_TCD, Peaklist_path, mask_dir, split_time, sampling_interval):
+    return reduce_run(filepath, compound_frame_TCD, Peaklist_path, mask_dir, split_time, sampling_interval)[0]
+
+
+def selectivity_columns(Peaklist_path, mask_dir):
+    # columns of the mass balance table as made by reduce_run: FID compound groups, hydrogen (TCD), GCxGC compound groups of the liquid and coke
+    FID_groups = [label for label in peak_labels(load_peaklist(Peaklist_path)) if label not in ['total', 'Propane', 'Propylene', 'Hydrogen']]
+    return FID_groups + ['Hydrogen'] + gcgc_utils.load_masks(mask_dir).names + ['unassigned', 'coke']
+
+
+def reduce_runs(filepaths, compound_frame_TCD, Peaklist_path, mask_dir, split_time=20, sampling_interval=4, max_workers=None):
+    '''
+    Mass balance table of a set of semibatch runs (run directories ending with '/'), one row per run indexed by the catalyst code, in the layout of Selectivities.csv.
+    The runs are reduced in a process pool (max_workers=1 for serial), see reduce_run. Without runs the table is empty, with the same columns.
+    '''
+    if len(filepaths) == 0:
+        return pd.DataFrame(columns=selectivity_columns(Peaklist_path, mask_dir), dtype=float)
+    arguments = [(filepath, compound_frame_TCD, Peaklist_path, mask_dir, split_time, sampling_interval) for filepath in filepaths]
+    if max_workers == 1 or len(filepaths) < 2:
+        rows = [_reduce_run_row(*argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(_reduce_run_row, *zip(*arguments)))
+    return pd.concat(rows)
+
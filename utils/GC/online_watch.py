@@ -0,0 +1,210 @@
+import io
+import os
+import glob
+import time
+from functools import partial
+import numpy as np
+import pandas as pd
+from utils.GC import online_gc_utils, online_pygcms_utils
+
+# Processing of online GC runs while the instrument is still writing the chromatograms.
+# A Watcher picks up the new files of a run, integrates only these and appends the integrals to a csv, so a restarted watch continues where it stopped.
+# The flows, yields and fits are recomputed from the stored integrals, which is cheap compared to reading and integrating the chromatograms.
+
+
+def injection_order(path):
+    # same order as sorted() followed by .sort(key=len), injection 10 comes after injection 9
+    return len(path), path
+
+
+class Watcher:
+    '''
+    Processes the files matching pattern (glob) that were not processed before, in the order given by sort_key.
+    process(path) returns a dictionary with the results of one file. A file is only processed once it was not modified for settle seconds.
+    A new injection is picked up within settle plus the polling interval (see watch), below a second with the defaults. Files that the instrument
+    writes over a longer time than settle could be read while incomplete, settle has to be raised for these.
+    If results_path is given, the results are appended to this csv (one row per file, with the path in the column 'file') and read back on a restart.
+    '''
+    def __init__(self, pattern, process, results_path=None, settle=0.5, sort_key=injection_order):
+        self.pattern = pattern
+        self.process = process
+        self.results_path = results_path
+        self.settle = settle
+        self.sort_key = sort_key
+        self.rows = []
+        if results_path is not None and os.path.exists(results_path):
+            self.rows = pd.read_csv(results_path).to_dict('records')
+        self.done = {row['file'] for row in self.rows}
+
+    def new_files(self):
+        now = time.time()
+        paths = [path for path in glob.glob(self.pattern) if path not in self.done and now - os.path.getmtime(path) >= self.settle]
+        return sorted(paths, key=self.sort_key)
+
+    def poll(self):
+        # processes the new files, returns their results as a frame
+        rows = []
+        for path in self.new_files():
+            rows.append(dict(self.process(path), file=path))
+            self.done.add(path)
+        if rows and self.results_path is not None:
+            pd.DataFrame(rows).to_csv(self.results_path, mode='a', header=not os.path.exists(self.results_path), index=False)
+        self.rows.extend(rows)
+        return pd.DataFrame(rows)
+
+    def results(self):
+        # results of all files processed so far, in the order of sort_key
+        rows = sorted(self.rows, key=lambda row: self.sort_key(row['file']))
+        return pd.DataFrame(rows)
+
+
+def watch(poll, interval=0.25, timeout=None, callback=None):
+    '''
+    Calls poll (e.g. Watcher.poll) every interval seconds, and callback with its output whenever new files came in.
+    A poll without new files only lists the directory, so short intervals are cheap.
+    Stops when no new files came in for timeout seconds (None: until interrupted).
+    '''
+    last = time.time()
+    try:
+        while True:
+            new = poll()
+            if len(new):
+                last = time.time()
+                if callback is not None:
+                    callback(new)
+            elif timeout is not None and time.time() - last > timeout:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+class LogTail:
+    '''Reads the labview log (see online_gc_utils.parse_log) while it is written, every read only parses the lines added since the last one.'''
+    def __init__(self, logfile_path):
+        self.path = logfile_path
+        self.offset = 0
+        self.names = None
+        self.log = None
+
+    def read(self):
+        # returns the new log entries, all entries are in self.log
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        data = data[:data.rfind(b'\n')+1] # only complete lines, the last one may still be written
+        if self.names is None:
+            lines = data.split(b'\n', 2)
+            if len(lines) < 3: # title and header are not there yet
+                return self.log
+            self.names = lines[1].decode().rstrip('\r').split('\t')
+            self.offset = len(lines[0]) + len(lines[1]) + 2
+            data = lines[2]
+        self.offset += len(data)
+        if data.strip():
+            new = online_gc_utils.format_log(pd.read_csv(io.BytesIO(data), sep='\t', header=None, names=self.names))
+        else:
+            new = self.log.iloc[:0] if self.log is not None else None
+        if new is not None:
+            self.log = new if self.log is None else pd.concat([self.log, new], ignore_index=True)
+        return new
+
+
+def _integrate_DMP_injection(Path, Peaknames, Peaks_channel2, Peaks_TCD, Peaks_channel1, cache_dir, windows):
+    integral, timestamp = online_gc_utils.integrate_injection(Path, Peaks_channel2, Peaks_TCD, Peaks_channel1, cache_dir, windows)
+    return dict(zip(Peaknames, integral), Timestamp=timestamp)
+
+
+class DMP_live:
+    '''
+    Live processing of a DMP cracking run (see online_gc_utils). New injections in chromdir are integrated and stored in results_path,
+    the log is read incrementally. summary() gives the normalized integrals, the rate constants and the Arrhenius fit of the run so far.
+    '''
+    def __init__(self, chromdir, logfile_path, Peaks_channel2, Peaks_TCD, Peaks_channel1, cat_mass_dry, results_path=None, pattern='*.txt', settle=0.5, cache_dir=None, no_chromatograms_norm=5, n_temperatures=4):
+        self.Peaknames = online_gc_utils.get_peaknames(Peaks_channel1, Peaks_channel2, Peaks_TCD)
+        process = partial(_integrate_DMP_injection, Peaknames=self.Peaknames, Peaks_channel2=Peaks_channel2, Peaks_TCD=Peaks_TCD, Peaks_channel1=Peaks_channel1, cache_dir=cache_dir, windows={})
+        self.watcher = Watcher(os.path.join(chromdir, pattern), process, results_path, settle, sort_key=os.path.basename)
+        self.log = LogTail(logfile_path)
+        self.cat_mass_dry = cat_mass_dry
+        self.no_chromatograms_norm = no_chromatograms_norm
+        self.n_temperatures = n_temperatures
+
+    def poll(self):
+        self.log.read()
+        return self.watcher.poll()
+
+    def integral_frame(self):
+        # integrals of all injections so far with temperature and valve positions, as from process_chromatograms and get_temp_and_valves
+        Integral_Frame = self.watcher.results()
+        if Integral_Frame.empty:
+            return Integral_Frame
+        Integral_Frame = Integral_Frame.drop(columns=['file'])
+        Integral_Frame['Timestamp'] = pd.to_datetime(Integral_Frame['Timestamp'])
+        if self.log.log is None or self.log.log.empty:
+            return Integral_Frame
+        return online_gc_utils.get_temp_and_valves(Integral_Frame, self.log.log)
+
+    def summary(self):
+        '''Returns the normalized integrals, the Arrhenius frame and the Arrhenius fit, or None as long as the bubbler was not opened.'''
+        Integral_Frame = self.integral_frame()
+        if 'v10-bubbler' not in Integral_Frame or (Integral_Frame['v10-bubbler'] == 1).sum() < 2:
+            return None
+        Integral_Frame, A0_DMP = online_gc_utils.normalize_integrals(Integral_Frame, self.no_chromatograms_norm)
+        molar_flow = online_gc_utils.DMP_molar_flow(A0_DMP)
+        Arrhenius_frame = online_gc_utils.get_arrhenius_frame(Integral_Frame, self.cat_mass_dry, molar_flow, self.n_temperatures)
+        return Integral_Frame, Arrhenius_frame, online_gc_utils.fit_arrhenius(Arrhenius_frame)
+
+
+def _integrate_TCD(chrom_path, compound_frame_TCD):
+    integrals, chromatogram = online_pygcms_utils.integrate_TCD_chromatogram(chrom_path, compound_frame_TCD)
+    return dict(zip(compound_frame_TCD.index, integrals))
+
+
+def _integrate_FID(chrom_path, Peaklist_path):
+    chromatogram, integral_frame_pA = online_pygcms_utils.process_chromatogram(chrom_path, Peaklist_path, 0)
+    return integral_frame_pA[0].to_dict()
+
+
+class Semibatch_live:
+    '''
+    Live processing of a semibatch cracking run in filepath (see online_pygcms_utils, meta.csv has to be there at the start).
+    TCD and FID chromatograms are integrated as they are written and stored in results_dir, summary() gives the flows and masses of the run so far.
+    The injection number is the position of the file in injection_order, the first FID injection is ignored as in the batch processing.
+    '''
+    def __init__(self, filepath, compound_frame_TCD, Peaklist_path, results_dir=None, settle=0.5):
+        self.meta_frame = online_pygcms_utils.get_meta(filepath)
+        self.calib_factors = online_pygcms_utils.get_calib_factors(self.meta_frame)
+        self.init = float(self.meta_frame['value']['GC start time:'])  # start time of filling the loops (min)
+        self.inj_time = float(self.meta_frame['value']['Time sampling loop: [min]']) # time of recording of 1 injection in min
+        self.compounds_TCD = compound_frame_TCD.index.to_list()
+        results_TCD = os.path.join(results_dir, 'TCD_integrals.csv') if results_dir is not None else None
+        results_FID = os.path.join(results_dir, 'FID_integrals.csv') if results_dir is not None else None
+        self.TCD = Watcher(filepath+'*TCD.txt*', partial(_integrate_TCD, compound_frame_TCD=compound_frame_TCD), results_TCD, settle)
+        self.FID = Watcher(filepath+'*FID_right*', partial(_integrate_FID, Peaklist_path=Peaklist_path), results_FID, settle)
+
+    def poll(self):
+        return pd.concat([self.TCD.poll(), self.FID.poll()])
+
+    def timelist(self, n):
+        return [self.init + self.inj_time*i for i in range(n)]
+
+    def summary(self):
+        '''
+        Returns the TCD flows, the FID carbon flows and the masses from TCD and FID of the injections so far, None before the second injection.
+        Only the injections recorded by both detectors are used, so a detector that is one injection ahead does not add zero flows.
+        '''
+        n = min(len(self.TCD.rows), len(self.FID.rows))
+        if n < 2:
+            return None
+        TCD_integrals = self.TCD.results().iloc[:n]
+        FID_integrals = self.FID.results().iloc[:n]
+        TCD_frame = TCD_integrals[self.compounds_TCD].set_axis(np.arange(n)+1)
+        flow_frame_TCD = online_pygcms_utils.calc_TCD_flows(TCD_frame, self.meta_frame)
+        total_masses_TCD = online_pygcms_utils.get_TCD_masses(flow_frame_TCD[['Propane', 'Propylene','Hydrogen']], self.timelist(n))
+
+        inj_time_timelist = self.timelist(n)[1:]
+        integral_frame_FID = FID_integrals.drop(columns=['file']).iloc[1:].T.set_axis(inj_time_timelist, axis=1) # the integral here is in pA*s
+        integral_frame_FID_mol = online_pygcms_utils.calc_molarCflow(integral_frame_FID, self.calib_factors, flow_frame_TCD)
+        # as in the batch processing, the carbon flows are on the times of the TCD flows, the first (ignored) FID injection counts as 0
+        total_masses_indiv = online_pygcms_utils.get_indiv_integrals(integral_frame_FID_mol, self.timelist(n))
+        return flow_frame_TCD, integral_frame_FID_mol, total_masses_TCD, total_masses_indiv
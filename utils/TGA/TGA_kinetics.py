@@ -0,0 +1,147 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import NamedTuple
+from scipy.stats import linregress
+from concurrent.futures import ProcessPoolExecutor
+from utils.TGA import TGA_utils as tga
+
+# Kinetics of isothermal plastic cracking experiments (TGA_pyro_iso).
+# The logarithm of the remaining plastic weight is fitted linearly in a conversion window (first order), giving the apparent rate constant k'.
+# ln(k') = -Ea/R * 1/T + n*ln([C]) + ln(A) is then fitted to all runs of a catalyst.
+# Loading (parsing) the runs is done once, refitting with a different conversion window only needs fit_isotherms.
+
+# weight offsets (mg) for runs with wrong taring, columns Filename and offset, next to the TGA results of the repository
+corrections_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'results', 'TGA', 'TGA_corrections.csv')
+R = 8.314
+
+fit_columns = ['slope', 'intercept', 'r_value', 'p_value', 'std_err', 'C_rel', 'temperature', 'file', 'lowbound', 'highbound', 'adjusted']
+
+
+class Isotherm(NamedTuple):
+    #the part of an isothermal run needed for the kinetics
+    file: str
+    time: np.ndarray # minutes since the start of the cracking stage
+    rel_weight: np.ndarray # remaining plastic in units of the plastic weight
+    C_rel: float # catalyst loading, m_cat/m_poly
+    temperature: float # °C
+
+
+def read_corrections(path = corrections_path):
+    #returns a dictionary of filename: weight offset, empty if there is no table
+    if path is None or not os.path.isfile(path):
+        return {}
+    table = pd.read_csv(path)
+    return dict(zip(table['Filename'], table['offset']))
+
+
+def read_isotherm(filepath, offset = 0.0, cache_dir = None):
+    tga_iso = tga.parse_txt(filepath, type='pyro_iso', calculate_DTGA=False, cache_dir=cache_dir)
+    if offset: # taring corrections, shifts the weight of the cracking and burnoff stage
+        for stage in [tga_iso.cracking_stage, tga_iso.burnoff_stage]:
+            frame = tga_iso.get_stage(stage).copy()
+            frame['Unsubtracted weight'] += offset
+            tga_iso.add_stage(stage, frame)
+    tga.calc_DTGA(tga_iso)
+    frame = tga_iso.cracking()
+    time = frame['Time'].to_numpy(dtype=float)
+    return Isotherm(os.path.basename(filepath), time-time[0], frame['rel_weight_pwl'].to_numpy(), tga_iso.m_cat()/tga_iso.m_poly(), float(tga_iso.temp()))
+
+
+def _read_isotherm(arguments):
+    return read_isotherm(*arguments)
+
+
+def load_isotherms(source, corrections = corrections_path, max_workers = None, cache_dir = None):
+    '''
+    Reads all isothermal runs found by tga.find_runs(source) in a process pool.
+    Returns a dictionary with a list of Isotherms for every experiment directory.
+    corrections is a path to a correction table or a dictionary of filename: offset.
+    '''
+    if not isinstance(corrections, dict):
+        corrections = read_corrections(corrections)
+    runs = tga.find_runs(source)
+    paths = [path for exp_paths in runs.values() for path in exp_paths]
+    arguments = [(path, corrections.get(os.path.basename(path), 0.0), cache_dir) for path in paths]
+    if max_workers == 1 or len(paths) < 2:
+        isotherms = [_read_isotherm(argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            isotherms = list(executor.map(_read_isotherm, arguments))
+
+    experiments = {}
+    i = 0
+    for exp, exp_paths in runs.items():
+        experiments[exp] = isotherms[i:i+len(exp_paths)]
+        i += len(exp_paths)
+    return experiments
+
+
+def fit_window(isotherm, start_conv = 0.85, conv = 0.3):
+    #returns the times (min) between which the fit is done and whether the window had to be adjusted
+    #the fit starts when start_conv of the plastic is left and stops at conv, or at the lowest weight if conv is not reached
+    rel_weight = isotherm.rel_weight
+    started = rel_weight <= start_conv
+    if not started.any(): # argmax would silently start the fit at the first point
+        raise ValueError('{}: the remaining plastic never drops below start_conv ({})'.format(isotherm.file, start_conv))
+    adjusted = np.nanmin(rel_weight) > conv
+    stop = np.nanmin(rel_weight) if adjusted else conv # always reached once start_conv is
+    lowbound = isotherm.time[np.argmax(started)]
+    highbound = isotherm.time[np.argmax(rel_weight <= stop)]
+    return lowbound, highbound, adjusted
+
+
+def fit_isotherm(isotherm, start_conv = 0.85, conv = 0.3):
+    #first order fit of a single run, the slope is -k' in 1/s
+    lowbound, highbound, adjusted = fit_window(isotherm, start_conv, conv)
+    window = (isotherm.time >= lowbound) & (isotherm.time <= highbound)
+    time = isotherm.time[window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_rel_weight = np.log(isotherm.rel_weight[window])
+    fit = linregress(time*60, log_rel_weight) #timeunit is in seconds!
+    return [fit.slope, fit.intercept, fit.rvalue, fit.pvalue, fit.stderr, isotherm.C_rel, isotherm.temperature, isotherm.file, lowbound, highbound, adjusted]
+
+
+def fit_isotherms(isotherms, start_conv = 0.85, conv = 0.3):
+    '''
+    Fits all isotherms of a catalyst in the conversion window, returns a frame with one row per run.
+    The default start_conv of 0.85 is the value used for all catalysts in the manuscript.
+    '''
+    return pd.DataFrame([fit_isotherm(isotherm, start_conv, conv) for isotherm in isotherms], columns=fit_columns)
+
+
+def fit_arrhenius(results):
+    '''
+    Linear least squares fit of ln(k') = a/T + b*ln([C]) + c to a frame of fit_isotherms results (temperature in °C).
+    Returns the Ea (kJ/mol), n and ln(A) with their errors as a dictionary and the covariance matrix of (a, b, c).
+    The covariance is s^2 (X^T X)^-1, the same as scipy curve_fit returns for this model.
+    '''
+    X = np.column_stack([1/(results['temperature'].to_numpy(dtype=float)+273.15), np.log(results['C_rel'].to_numpy(dtype=float)), np.ones(len(results))])
+    y = np.log(-results['slope'].to_numpy(dtype=float))
+    params, residuals, rank, sv = np.linalg.lstsq(X, y, rcond=None)
+    dof = len(y) - 3
+    s2 = np.sum((y - X @ params)**2)/dof if dof > 0 else np.inf
+    covariance = s2*np.linalg.pinv(X.T @ X)
+    error = np.sqrt(np.diag(covariance))
+    a_fit, b_fit, c_fit = params
+    fit_output = {'Ea_PP': -a_fit*R/1000, 'Ea_error_PP': error[0]*R/1000, 'n_PP': b_fit, 'n_error_PP': error[1], 'ln(A)_PP': c_fit, 'ln(A)_error_PP': error[2]}
+    return fit_output, covariance
+
+
+def process_isothermal(source, start_conv = 0.85, conv = 0.3, corrections = corrections_path, max_workers = None, output_directory = None, cache_dir = None):
+    '''
+    Loads and fits all isothermal runs found by tga.find_runs(source), grouped by experiment directory.
+    Returns a dictionary of the fit frames per experiment, a frame with the Arrhenius parameters (one row per experiment)
+    and a dictionary of the covariance matrices. With an output_directory the fit frames are written to <exp>.csv (separators in exp replaced by _).
+    '''
+    experiments = load_isotherms(source, corrections, max_workers, cache_dir)
+    results = {}
+    arrhenius = {}
+    covariances = {}
+    for exp, isotherms in experiments.items():
+        results[exp] = fit_isotherms(isotherms, start_conv, conv)
+        arrhenius[exp], covariances[exp] = fit_arrhenius(results[exp])
+        if output_directory is not None:
+            os.makedirs(output_directory, exist_ok=True)
+            results[exp].to_csv(os.path.join(output_directory, exp.replace('/', '_')+'.csv'), index=False)
+    return results, pd.DataFrame.from_dict(arrhenius, orient='index'), covariances
@@ -4,7 +4,12 @@ import io
 import re
 from matplotlib import pyplot as plt
 import os
+import glob
 import warnings
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor
+from scipy.signal import savgol_filter
+from utils.misc import file_cache
 
 # 
 class TGA_exp:
@@ -29,50 +34,69 @@ class TGA_exp:
 
 
 
-class TGA_pyro(TGA_exp):
-    #TGA class for a ramped plastic cracking experiments. Key stages are cracking(heating under N2) and burnoff(heating under O2).
+class TGA_summary(NamedTuple):
+    #mass balance of a plastic cracking experiment, one row of a results table
+    m_cat: float
+    m_poly: float
+    m_coke: float
+    pct_loss: float
+    P_C_ratio: float
+    coke_yield: float
+
+
+class TGA_cracking(TGA_exp):
+    #Shared mass balance of the plastic cracking experiments. Subclasses set the names of the cracking(under N2) and burnoff(under O2) stages.
+    #The masses are calculated once and kept until a stage is added or replaced, call invalidate() after changing a stage frame in place.
+    cracking_stage = None
+    burnoff_stage = None
     def __init__(self, stage_files=None):
+        self._summary = None
         super().__init__(stage_files)
         self.Tmax = None
         self.T50 = None
+    def add_stage(self, stage, data):
+        super().add_stage(stage, data)
+        self._summary = None
+    def invalidate(self):
+        self._summary = None
     def cracking(self):
-        return self.stages['stage4'] # If the TAa method is changed, this needs to be adjusted accordingly
+        return self.stages[self.cracking_stage]
     def burnoff(self):
-        return self.stages['stage8']
+        return self.stages[self.burnoff_stage]
+    def summary(self):
+        # one min/max scan per stage, all masses follow from these. pd.DataFrame([exp.summary() for exp in experiments]) gives a results table
+        if self._summary is None:
+            cracking = self.cracking()['Unsubtracted weight'].to_numpy()
+            m_cat = np.float64(self.burnoff()['Unsubtracted weight'].min())
+            m_poly = np.float64(cracking.max()) - m_cat
+            m_coke = np.float64(cracking.min()) - m_cat
+            with np.errstate(divide='ignore', invalid='ignore'): # numpy scalars give inf/nan for empty or failed runs instead of raising
+                self._summary = TGA_summary(m_cat, m_poly, m_coke, m_poly/(m_poly+m_cat), m_poly/m_cat, m_coke/m_poly)
+        return self._summary
     def m_cat(self):# returns the amount of catalyst
-        return self.burnoff()['Unsubtracted weight'].min()
+        return self.summary().m_cat
     def m_poly(self): # returns the amount of polymer
-        return self.cracking()['Unsubtracted weight'].max() - self.m_cat()
+        return self.summary().m_poly
     def m_coke(self):
-        return self.cracking()['Unsubtracted weight'].min()-self.m_cat()
+        return self.summary().m_coke
     def pct_loss(self):
-        return self.m_poly()/(self.m_poly()+self.m_cat())
+        return self.summary().pct_loss
     def P_C_ratio(self):
-        return self.m_poly()/self.m_cat()
+        return self.summary().P_C_ratio
     def coke_yield(self):
-        return self.m_coke()/self.m_poly()
+        return self.summary().coke_yield
+
+
+class TGA_pyro(TGA_cracking):
+    #TGA class for a ramped plastic cracking experiments. Key stages are cracking(heating under N2) and burnoff(heating under O2).
+    cracking_stage = 'stage4' # If the TAa method is changed, this needs to be adjusted accordingly
+    burnoff_stage = 'stage8'
 
 
-class TGA_pyro_iso(TGA_exp):
+class TGA_pyro_iso(TGA_cracking):
     #TGA for a isothermal plastic cracking experiments. 
-    def __init__(self, stage_files=None):
-        super().__init__(stage_files)
-        self.Tmax = None
-        self.T50 = None
-    def cracking(self):
-        return self.stages['stage5']
-    def burnoff(self):
-        return self.stages['stage7']
-    def m_cat(self):# returns the amount of catalyst
-        return self.burnoff()['Unsubtracted weight'].min()
-    def m_poly(self): # returns the amount of polymer
-        return self.cracking()['Unsubtracted weight'].max() - self.m_cat()
-    def m_coke(self):
-        return self.cracking()['Unsubtracted weight'].min()-self.m_cat()
-    def pct_loss(self):
-        return self.m_poly()/(self.m_poly()+self.m_cat())
-    def P_C_ratio(self):
-        return self.m_poly()/self.m_cat()
+    cracking_stage = 'stage5'
+    burnoff_stage = 'stage7'
     def temp(self):
         return np.round(self.cracking()['Sample Temp.'].iloc[-1],0)
 
@@ -80,8 +104,84 @@ class TGA_pyro_iso(TGA_exp):
 
 ###
 
-def parse_txt(filepath,type = 'general',calculate_DTGA = True): # type can be 'general' or 'pyro'
-    #Parser for PerkinElmer TGA8000 ASCII output files. Splits the file into stages using an regex.
+tga_columns = ['Blank', 'Time', 'Unsubtracted weight', 'Baseline weight',
+               'Program Temp.', 'Sample Temp.', 'Sample Purge Flow',
+               'Balance purge flow']
+
+_stage_marker = re.compile(r'(\d+)\) TGA$')
+_end_of_numbers = re.compile(r'\n(?![\t \d.+-])') # first line that does not start like a row of numbers
+
+def _read_stage(text, start, end):
+    # parses the rows of numbers of one stage into a frame backed by a single float array.
+    # The two lines following the stage marker (rest of the marker line and the column header) are skipped.
+    for i in range(2):
+        start = text.find('\n', start, end)+1
+        if start == 0:
+            return pd.DataFrame(columns=tga_columns)
+    stop = _end_of_numbers.search(text, start, end)
+    block = text[start:stop.start() if stop else end]
+    first_line = block[:block.find('\n')]
+    fields = first_line.split('\t')
+    if len(fields) == len(tga_columns) and fields[0] == '' and all(fields[1:]):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(block, sep=' ') # C-speed, any whitespace separates numbers
+            except (ValueError, DeprecationWarning):
+                values = None
+        # empty fields are skipped by the whitespace split, so the numbers are only taken if every row has all of its fields
+        n_rows = block.rstrip('\r\n').count('\n')+1
+        n_fields = n_rows*(len(tga_columns)-1)
+        if values is not None and values.size == n_fields and block.count('\t') == n_fields:
+            frame = pd.DataFrame(values.reshape(-1, len(tga_columns)-1), columns=tga_columns[1:])
+            frame.insert(0, 'Blank', np.nan)
+            return frame
+    return pd.read_csv(io.StringIO(block), sep='\t', header=None, names=tga_columns, engine='c')
+
+parser_version = 3 # increase when the parsing changes, invalidates cached stages
+
+def _parse_stages(filepath):
+    # returns a dictionary with a frame for every stage in the file
+    with open(filepath) as full:
+        text = full.read()
+    markers = []
+    position = text.find(') TGA')
+    while position != -1: # str.find is much faster than scanning every digit of the file with the regex
+        marker = _stage_marker.search(text, max(position-20, 0), position+5)
+        if marker:
+            markers.append(marker)
+        position = text.find(') TGA', position+5)
+    stages = {}
+    for i, marker in enumerate(markers):
+        end = markers[i+1].start() if i+1 < len(markers) else len(text)
+        stages['stage'+marker.group(1)] = _read_stage(text, marker.end(), end)
+    return stages
+
+def _load_stages(filepath, cache_dir):
+    # stages are cached column-wise as (columns, rows) float arrays, which are memory-mapped and wrapped into frames without copying
+    key = file_cache.cache_key(filepath, 'TGA_utils.parse_txt {}'.format(parser_version))
+    cached = file_cache.load(key, cache_dir)
+    if cached is not None:
+        arrays, meta = cached
+        stages = {}
+        for stage in meta['stages']:
+            frame = pd.DataFrame(arrays[stage].T, columns=tga_columns[1:], copy=False)
+            frame.insert(0, 'Blank', np.nan)
+            stages[stage] = frame
+        return stages
+
+    stages = _parse_stages(filepath)
+    try:
+        arrays = {stage: np.ascontiguousarray(frame[tga_columns[1:]].to_numpy(dtype=float).T) for stage, frame in stages.items()}
+    except (ValueError, TypeError): # stages with text in the numeric columns are not cached
+        return stages
+    file_cache.store(key, arrays, meta={'stages': list(stages.keys())}, sources=filepath, cache_dir=cache_dir)
+    return stages
+
+def parse_txt(filepath,type = 'general',calculate_DTGA = True, cache_dir = None): # type can be 'general', 'pyro' or 'pyro_iso'
+    #Parser for PerkinElmer TGA8000 ASCII output files. The stage markers ('1) TGA', '2) TGA', ...) are found in one pass over the file,
+    #the numbers of every stage are parsed in C straight into a float array.
+    #If a cache_dir is given (e.g. file_cache.default_dir), the parsed stages are stored there and reused until the file changes.
     if type == 'general':
         tga_exp_instance = TGA_exp()  # Create an instance of TGA_exp
     elif type == 'pyro':
@@ -89,50 +189,103 @@ def parse_txt(filepath,type = 'general',calculate_DTGA = True): # type can be 'g
     elif type == 'pyro_iso':
         tga_exp_instance = TGA_pyro_iso()
     else:
-        raise ValueError("type must be 'general' or 'pyro'")
-    names = ['Blank', 'Time', 'Unsubtracted weight', 'Baseline weight',
-            'Program Temp.', 'Sample Temp.', 'Sample Purge Flow',
-            'Balance purge flow']
+        raise ValueError("type must be 'general', 'pyro' or 'pyro_iso'")
 
-    def read_section(data):
-        frame = pd.read_table(io.StringIO(data), sep='\t', header=None,skiprows=2,
-                                names=names, engine='python')
-        return frame
-
-    with open(filepath) as full:
-        text = full.read()
-        split = re.split(r'(\d+\) TGA)', text) #important bit right here
-        section_numbers = [int(element[0:-5]) for element in split[1::2]]
-        sections = split[2::2]
-
-    for i in range(len(section_numbers)): 
-        tga_exp_instance.add_stage('stage'+str(section_numbers[i]), read_section(sections[i]))
+    if cache_dir is None:
+        stages = _parse_stages(filepath)
+    else:
+        stages = _load_stages(filepath, cache_dir)
+    for stage, frame in stages.items():
+        tga_exp_instance.add_stage(stage, frame)
 
     if calculate_DTGA == True:
         return calc_DTGA(tga_exp_instance)
     else:
         return tga_exp_instance
 
-def calc_DTGA(tga_exp, averaging_window = 30): #smooths the derivative with a moving average over a window of 30 datapoints
+dtga_columns = ['rel_weight_twl', 'rel_weight_pwl', 'DTGA_pwl', 'DTGA_twl']
+
+def smoothing_window(kernel, averaging_window):
+    #normalized weights of the moving average, identical to the scipy windows used by pandas rolling(win_type=...)
+    n = averaging_window
+    if kernel == 'triang':
+        half = np.arange(1, (n+1)//2+1)
+        if n % 2 == 0:
+            half = (2*half-1)/n
+            weights = np.concatenate([half, half[::-1]])
+        else:
+            half = 2*half/(n+1)
+            weights = np.concatenate([half, half[-2::-1]])
+    elif kernel == 'boxcar':
+        weights = np.ones(n)
+    elif kernel == 'hann':
+        weights = np.hanning(n)
+    else:
+        raise ValueError("kernel must be 'triang', 'boxcar', 'hann' or 'savgol'")
+    return weights/weights.sum()
+
+def _smooth_derivative(y, x, kernel, averaging_window, polyorder, out):
+    # writes -dy/dx smoothed with the kernel into out
+    n = len(y)
+    if n < 2:
+        out[:] = np.nan
+    elif kernel == 'savgol': # centred Savitzky-Golay derivative, the chain rule handles the non-uniform temperature steps
+        window = min(averaging_window, n)
+        window -= 1 - window % 2 # odd window that fits the stage
+        if window <= polyorder:
+            out[:] = -np.gradient(y, x)
+        else:
+            np.divide(-savgol_filter(y, window, polyorder, deriv=1), savgol_filter(x, window, polyorder, deriv=1), out=out)
+    else: # trailing moving average like pandas rolling(), the first averaging_window-1 points are NaN
+        weights = smoothing_window(kernel, averaging_window)
+        gradient = np.gradient(y, x)
+        out[:averaging_window-1] = np.nan
+        if n >= averaging_window:
+            out[averaging_window-1:] = np.convolve(gradient, -weights[::-1], mode='valid')
+
+def calc_DTGA(tga_exp, averaging_window = 30, kernel = 'triang', stages = None, polyorder = 2): #smooths the derivative with a moving average over a window of 30 datapoints
     # calculates the derivative of the TGA curve for a plastic cracking experimen in units of total sample weight or just the plastic weight.
-    # adds this derivative as a column to the dataframe of each stage.
+    # adds this derivative as a column to the dataframe of the cracking and burnoff stages, or of the given list of stage names (stages='all' for every stage).
+    # The first datapoints of the cracking and burnoff stages (at the starting temperature) are removed, other stages are kept as they are.
+    # kernel is 'triang' (default), 'boxcar' or 'hann' for a trailing moving average, or 'savgol' for a centred Savitzky-Golay derivative.
+    # A general TGA_exp has no cracking and burnoff stages, so nothing is calculated unless stages are given.
+    # The weight in units of plastic weight (pwl) is only calculated for experiments with a catalyst mass (TGA_pyro, TGA_pyro_iso).
+    key_stages = [name for name in [getattr(tga_exp, 'cracking_stage', None), getattr(tga_exp, 'burnoff_stage', None)] if name is not None]
+    if stages is None:
+        stages = key_stages
+    elif stages == 'all':
+        stages = tga_exp.stage_names()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        for stage in [tga_exp.cracking(),tga_exp.burnoff()]:
-            stage.drop(stage.index[stage['Sample Temp.'] == stage['Sample Temp.'].iloc[0]], inplace=True) # removing a couple datapoints to avoid infinities
-
-            rel_weight_twl = (stage['Unsubtracted weight']/stage['Unsubtracted weight'].max()).to_numpy()
-            rel_weight_pwl = ((stage['Unsubtracted weight']-tga_exp.m_cat())/tga_exp.m_poly()).to_numpy()
-
-            stage['rel_weight_twl'] = rel_weight_twl
-            stage['rel_weight_pwl'] = rel_weight_pwl
+        for name in stages:
+            stage = tga_exp.stages[name]
+            if name in key_stages: # removing a couple datapoints to avoid infinities
+                temp = stage['Sample Temp.'].to_numpy()
+                if len(temp):
+                    stage = stage.loc[temp != temp[0]]
+            tga_exp.add_stage(name, stage.drop(columns=dtga_columns, errors='ignore'))
 
-            temp = stage['Sample Temp.'].to_numpy()
+        # the masses are only calculated once, after the datapoints are removed
+        if hasattr(tga_exp, 'm_cat'):
+            m_cat = tga_exp.m_cat()
+            m_poly = tga_exp.m_poly()
+        else:
+            m_cat = m_poly = np.nan
 
-            stage['DTGA_pwl'] = -np.gradient(rel_weight_pwl,temp)
-            stage['DTGA_pwl']=stage['DTGA_pwl'].rolling(averaging_window,win_type='triang').mean()
-            stage['DTGA_twl'] = -np.gradient(rel_weight_twl,temp)
-            stage['DTGA_twl']=stage['DTGA_twl'].rolling(averaging_window,win_type='triang').mean()
+        for name in stages:
+            stage = tga_exp.stages[name]
+            weight = stage['Unsubtracted weight'].to_numpy(dtype=float)
+            temp = stage['Sample Temp.'].to_numpy(dtype=float)
+            derived = np.empty((len(weight), 4)) # all new columns are computed into one block and added with a single concat
+            rel_weight_twl, rel_weight_pwl, DTGA_pwl, DTGA_twl = derived.T
+            if len(weight):
+                np.divide(weight, weight.max(), out=rel_weight_twl)
+            np.subtract(weight, m_cat, out=rel_weight_pwl)
+            rel_weight_pwl /= m_poly
+            _smooth_derivative(rel_weight_pwl, temp, kernel, averaging_window, polyorder, DTGA_pwl)
+            _smooth_derivative(rel_weight_twl, temp, kernel, averaging_window, polyorder, DTGA_twl)
+            derived = pd.DataFrame(derived, index=stage.index, columns=dtga_columns, copy=False)
+            tga_exp.add_stage(name, pd.concat([stage, derived], axis=1))
     return tga_exp
 
 def calc_Tmax(tga_exp,stage='cracking'):
@@ -154,6 +307,75 @@ def calc_T50(tga_exp,stage='cracking'):
 
 
 
+### Batch processing
+
+result_columns = {'pyro':['Filename','m_polymer','m_cat','coke_yield','P/C ratio','Tmax','T50'],
+                  'pyro_iso':['Filename','m_polymer','m_cat','P/C ratio','temperature']}
+
+def process_file(filepath, type = 'pyro', cache_dir = None):
+    #parses and analyses a single TGA run, returns one row of the results table
+    tga_exp = parse_txt(filepath, type=type, cache_dir=cache_dir)
+    if type == 'pyro':
+        tga_exp.Tmax = calc_Tmax(tga_exp, stage='cracking')
+        tga_exp.T50 = calc_T50(tga_exp, stage='cracking')
+        return [os.path.basename(filepath), tga_exp.m_poly(), tga_exp.m_cat(), tga_exp.coke_yield(), tga_exp.P_C_ratio(), tga_exp.Tmax, tga_exp.T50]
+    elif type == 'pyro_iso':
+        return [os.path.basename(filepath), tga_exp.m_poly(), tga_exp.m_cat(), tga_exp.P_C_ratio(), tga_exp.temp()]
+    else:
+        raise ValueError("type must be 'pyro' or 'pyro_iso'")
+
+def find_runs(source, extension = '.txt'):
+    '''
+    Collects TGA files from a directory tree, a glob pattern or a list of paths.
+    Returns a dictionary with the directory containing the files (the experiment, e.g. SR_TGA_0081_Z04) as key and a sorted list of paths as value.
+    The key is the path of the directory relative to source (or to the directory shared by all files), so folders with the same name
+    in different places are kept apart, e.g. 'ramped/SR_TGA_0081_Z04' and 'isothermal/SR_TGA_0081_Z04'.
+    '''
+    if isinstance(source, (list, tuple)):
+        paths = list(source)
+    elif os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '**', '*'+extension), recursive=True)
+    else:
+        paths = glob.glob(source, recursive=True)
+    directories = [os.path.dirname(os.path.abspath(path)) for path in paths]
+    if not isinstance(source, (list, tuple)) and os.path.isdir(source):
+        root = os.path.abspath(source)
+    elif directories:
+        root = os.path.commonpath(directories)
+    runs = {}
+    for directory, path in sorted(zip(directories, paths), key=lambda item: item[1]):
+        key = os.path.relpath(directory, root)
+        key = os.path.basename(root) if key == '.' else key.replace(os.sep, '/')
+        runs.setdefault(key, []).append(path)
+    return runs
+
+def process_batch(source, type = 'pyro', max_workers = None, output_directory = None, cache_dir = None):
+    '''
+    Parses and analyses all TGA runs found by find_runs(source) in a process pool, parsed stages are cached in cache_dir (see parse_txt).
+    Returns a dictionary with one results table per experiment directory (one catalyst), the same tables the notebook writes to
+    results/TGA/outputs_ramped. If output_directory is given, each table is saved there as Results_<experiment>.csv.
+    '''
+    runs = find_runs(source)
+    paths = [path for files in runs.values() for path in files]
+    if max_workers == 1:
+        rows = [process_file(path, type, cache_dir) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(process_file, paths, [type]*len(paths), [cache_dir]*len(paths)))
+
+    if output_directory is not None:
+        os.makedirs(output_directory, exist_ok=True)
+    results = {}
+    start = 0
+    for exp_name, files in runs.items():
+        results[exp_name] = pd.DataFrame(rows[start:start+len(files)], columns=result_columns[type])
+        start += len(files)
+        if output_directory is not None:
+            results[exp_name].to_csv(os.path.join(output_directory, 'Results_'+exp_name.replace('/', '_')+'.csv'))
+    return results
+
+
+
 def get_color(min_rel_weight,cmap='viridis'):
     norm = plt.Normalize(0, 1.07)
     color = plt.get_cmap(cmap)(norm(min_rel_weight))
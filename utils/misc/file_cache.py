@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+# Disk cache for data parsed from raw files. Every entry is a directory containing one .npy file per array and a meta.json,
+# keyed on the path, modification time and size of the source files and the version of the parser.
+# Arrays are memory-mapped when loaded, so only the parts that are used are read from disk.
+# The default cache lives in the repository (next to utils/), independent of the working directory of the notebook or script.
+default_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), '.cache')
+default_max_bytes = 2*1024**3
+
+
+def cache_key(sources, version):
+    #hash of the source files and the parser version. Changing a source file (or the parser) gives a new key.
+    if isinstance(sources, str):
+        sources = [sources]
+    h = hashlib.sha1(str(version).encode())
+    for source in sources:
+        stat = os.stat(source)
+        h.update('{}|{}|{}'.format(os.path.abspath(source), stat.st_mtime_ns, stat.st_size).encode())
+    return h.hexdigest()
+
+
+def load(key, cache_dir = default_dir, mmap_mode = 'c'):
+    '''Returns the arrays (dictionary) and metadata of a cache entry, or None if there is no entry for the key.'''
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(entry, name+'.npy'), mmap_mode=mmap_mode) for name in meta['arrays']}
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        os.utime(entry) # marks the entry as recently used for the eviction
+    except FileNotFoundError: # evicted by another process in the meantime, the opened arrays stay readable
+        pass
+    return arrays, meta
+
+
+def store(key, arrays, meta = None, sources = (), cache_dir = default_dir, max_bytes = default_max_bytes):
+    '''Writes a dictionary of arrays and a json-serializable meta dictionary to the cache, then evicts old entries above max_bytes.'''
+    entry = os.path.join(cache_dir, key)
+    tmp = entry + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name+'.npy'), np.asarray(array))
+    meta = dict(meta or {}, arrays=list(arrays.keys()), sources=[os.path.abspath(source) for source in ([sources] if isinstance(sources, str) else sources)])
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, entry) # entries appear complete or not at all, also with several processes writing
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict(cache_dir, max_bytes)
+
+
+def _entries(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+    return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if '.tmp' not in name]
+
+
+def _stat(entry):
+    # modification time and size of an entry, None if it was removed (e.g. by another process) while the cache is scanned
+    try:
+        return os.path.getmtime(entry), sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+    except FileNotFoundError:
+        return None
+
+
+def evict(cache_dir = default_dir, max_bytes = default_max_bytes):
+    #removes the least recently used entries until the cache is smaller than max_bytes
+    stats = [(entry, _stat(entry)) for entry in _entries(cache_dir)]
+    stats = sorted([(stat, entry) for entry, stat in stats if stat is not None])
+    total = sum(size for (mtime, size), entry in stats)
+    for (mtime, size), entry in stats:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def invalidate(sources = None, cache_dir = default_dir):
+    '''Removes all entries made from any of the source files, or the whole cache if sources is None.'''
+    if sources is None:
+        for entry in _entries(cache_dir):
+            shutil.rmtree(entry, ignore_errors=True)
+        return
+    if isinstance(sources, str):
+        sources = [sources]
+    sources = {os.path.abspath(source) for source in sources}
+    for entry in _entries(cache_dir):
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                entry_sources = json.load(f)['sources']
+        except (OSError, ValueError, KeyError):
+            entry_sources = []
+        if sources.intersection(entry_sources):
+            shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+# Alignment of measurement timestamps (GC injections, IR spectra) with log files, as a sorted as-of join.
+# Timestamps are compared as int64 nanoseconds, tz-aware timestamps in UTC.
+
+
+def _as_ns(times):
+    times = pd.DatetimeIndex(times)
+    aware = times.tz is not None
+    if aware:
+        times = times.tz_convert('UTC').tz_localize(None)
+    return np.asarray(times, dtype='datetime64[ns]').view('int64'), aware
+
+
+def match_times(reference_times, times, direction = 'nearest'):
+    '''
+    Returns for every time the position of the matching row in reference_times (e.g. the timestamps of a log file).
+    direction 'nearest': closest reference time, the first row if several are equally close (like Series.sub(x).abs().idxmin()).
+    direction 'forward': first reference time at or after the time, 'backward': last reference time at or before the time.
+    Times outside the reference range get the first or last row. Needs O((n + m) log n) for n reference times and m times.
+    '''
+    reference, reference_tz = _as_ns(reference_times)
+    values, values_tz = _as_ns(times)
+    if reference_tz != values_tz:
+        raise TypeError('Cannot compare tz-naive and tz-aware timestamps')
+    n = len(reference)
+    if n == 0:
+        raise ValueError('No reference times to match to')
+    order = None
+    if np.any(np.diff(reference) < 0):
+        order = np.argsort(reference, kind='stable')
+        reference = reference[order]
+
+    if direction == 'forward':
+        positions = np.clip(np.searchsorted(reference, values, side='left'), 0, n-1)
+    elif direction == 'backward':
+        positions = np.clip(np.searchsorted(reference, values, side='right') - 1, 0, n-1)
+    elif direction == 'nearest':
+        after = np.clip(np.searchsorted(reference, values, side='left'), 0, n-1)
+        before = np.clip(after - 1, 0, n-1)
+        before = np.searchsorted(reference, reference[before], side='left') # first of equal reference times (stable sort)
+        distance_before = np.abs(values - reference[before])
+        distance_after = np.abs(reference[after] - values)
+        # equally close times before and after: the one that comes first in the original order, as idxmin
+        rank = np.arange(n) if order is None else order
+        first = (distance_before < distance_after) | ((distance_before == distance_after) & (rank[before] <= rank[after]))
+        positions = np.where(first, before, after)
+    else:
+        raise ValueError("direction must be 'nearest', 'forward' or 'backward'")
+    return positions if order is None else order[positions]
+
+
+def attach_log(frame, log, columns, time_column = 'Timestamp', log_time_column = 'timestamp', direction = 'nearest'):
+    '''
+    Adds log columns to frame, taken from the log row matching each timestamp in frame[time_column] (see match_times).
+    columns is a list of log columns or a dictionary {log column: new column name}. Returns the frame.
+    '''
+    if not isinstance(columns, dict):
+        columns = {column: column for column in columns}
+    positions = match_times(log[log_time_column], frame[time_column], direction)
+    for log_column, name in columns.items():
+        frame[name] = log[log_column].to_numpy()[positions]
+    return frame
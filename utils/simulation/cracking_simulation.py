@@ -2,6 +2,10 @@ import random
 import numpy as np
 from matplotlib import pyplot as plt
 import math
+import itertools
+import warnings
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 
@@ -18,7 +22,7 @@ def crack_molecules(reactor,model):
     normalized_probabilities = model(selected_molecule[0])
 
     selected_zero = random.choices(selected_list, weights=normalized_probabilities, k=1)
- 
+
     #get the index of the selected molecule
     index = reactor.index(selected_molecule[0])
     #split the molecule at the selected zero, replace the orginal molecule with the two new molecules
@@ -41,4 +45,332 @@ def status(list):
     mass = sum([sum(molecule) for molecule in list])
     try: Mn = mass/lenght
     except ZeroDivisionError: Mn = 0
-    return [lenght, mass, Mn]
\ No newline at end of file
+    return [lenght, mass, Mn]
+
+
+
+### Array-backed engine
+
+def make_molecule(n_carbons):
+    '''Returns a 'polymer' molecule of n_carbons 1s (carbon atoms) connected by 0s (bonds), e.g. [1,0,1,0,1] for 3 carbons.'''
+    molecule = [1,0] * (n_carbons-1)
+    molecule.append(1)
+    return molecule
+
+
+# Vectorized probability models. They take the number of bonds in a molecule and return the probability of each bond.
+def prob_gaussian(n_bonds):
+    '''
+    Probability is described by a gaussian centered around the middle of the chain, with a st. dev. of 20% of the length of the chain.
+    When the chain becomes to short (5 bonds or less), the probability is set to be uniform across the molecule.
+    '''
+    if n_bonds <= 0:
+        return np.zeros(0)
+    if n_bonds <= 5:
+        return np.full(n_bonds, 1/n_bonds)
+    mean = n_bonds // 2
+    std_dev = n_bonds // 5
+    probabilities = np.exp(-(np.arange(n_bonds) - mean)**2 / (2 * std_dev**2))
+    return probabilities/probabilities.sum()
+
+def prob_exp_fromend(n_bonds, cutoff = 30):
+    '''Probability is described by an exponential function with a cutoff at 30 bonds from the end of the chain.'''
+    if n_bonds <= 0:
+        return np.zeros(0)
+    positions = np.arange(n_bonds)
+    probabilities = np.where(positions < cutoff, np.exp(-np.minimum(positions, cutoff)), 0)
+    return probabilities/probabilities.sum()
+
+def vectorize_model(model):
+    '''Wraps a model taking a list of 1s and 0s (as used with crack_molecules) into a model taking the number of bonds.'''
+    def vectorized(n_bonds):
+        return np.asarray(model(make_molecule(n_bonds+1)), dtype=float)
+    vectorized.__name__ = getattr(model, '__name__', 'model')
+    return vectorized
+
+@lru_cache(maxsize=4096)
+def _cumulative_weights(model, n_bonds):
+    # the bond weights only depend on the number of bonds in the molecule, so they are computed once per length
+    return np.cumsum(model(n_bonds))
+
+
+class _FenwickTree:
+    # binary indexed tree of non-negative integer weights. Updates and weighted sampling are O(log n).
+    def __init__(self, weights):
+        self.values = [int(w) for w in weights]
+        self._build()
+
+    def _build(self):
+        self.size = len(self.values)
+        self.tree = [0] + self.values
+        for i in range(1, self.size+1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self.tree[j] += self.tree[i]
+        self.top = 1 << (self.size.bit_length()-1) if self.size else 0
+
+    def grow(self, size):
+        self.values.extend([0]*(size-self.size))
+        self._build()
+
+    def add(self, index, delta):
+        self.values[index] += delta
+        i = index+1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, u):
+        # returns the index i for which cumsum(values)[i-1] <= u < cumsum(values)[i]
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= u:
+                pos = nxt
+                u -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+
+class ArrayReactor:
+    '''
+    Reactor for the cracking simulation storing all molecules as slices of one contiguous array of 1s (carbon) and 0s (bonds).
+    Every molecule is an (offset, length) pair into this array, so cracking a bond only changes two pairs.
+    The number of bonds and the mass of each molecule are looked up in cumulative sums of the array,
+    the molecule to crack is drawn from the bond counts kept in a Fenwick tree and the bond from the cumulative model weights, both in O(log n).
+    Molecules with a mass <= min_length are moved to the products as soon as they are formed.
+    model is a vectorized probability model (e.g. prob_gaussian), see vectorize_model for models used with crack_molecules.
+    '''
+    def __init__(self, molecules, model, min_length = 10, rng = None):
+        self.model = model
+        self.min_length = min_length
+        self.rng = np.random.default_rng(rng)
+
+        units = [np.asarray(molecule, dtype=np.int8) for molecule in molecules]
+        lengths = np.array([len(molecule) for molecule in units], dtype=np.int64)
+        self.units = np.concatenate(units) if units else np.zeros(0, dtype=np.int8)
+        self.bond_positions = np.flatnonzero(self.units == 0)
+        self.bond_cumsum = np.concatenate([[0], np.cumsum(self.units == 0)])
+        self.mass_cumsum = np.concatenate([[0], np.cumsum(self.units)])
+
+        self.n_molecules = len(units)
+        capacity = max(2*self.n_molecules, 16)
+        self.offset = np.zeros(capacity, dtype=np.int64)
+        self.length = np.zeros(capacity, dtype=np.int64)
+        self.offset[:self.n_molecules] = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if units else []
+        self.length[:self.n_molecules] = lengths
+        self.in_reactor = np.zeros(capacity, dtype=bool)
+        self.in_reactor[:self.n_molecules] = True
+
+        self.reactor_count = self.n_molecules
+        self.reactor_mass = int(self.mass_cumsum[-1])
+        self.product_count = 0
+        self.product_mass = 0
+
+        self.bonds = _FenwickTree(np.zeros(capacity, dtype=np.int64))
+        self.total_bonds = 0
+        for i in range(self.n_molecules):
+            self._place(i, self.offset[i], self.length[i])
+
+    def _molecule_bonds(self, offset, length):
+        return int(self.bond_cumsum[offset+length] - self.bond_cumsum[offset])
+
+    def _molecule_mass(self, offset, length):
+        return int(self.mass_cumsum[offset+length] - self.mass_cumsum[offset])
+
+    def _place(self, i, offset, length):
+        # writes a (new) molecule into slot i and moves it to the products if it is short enough
+        self.offset[i] = offset
+        self.length[i] = length
+        mass = self._molecule_mass(offset, length)
+        if mass <= self.min_length:
+            self.in_reactor[i] = False
+            self.reactor_count -= 1
+            self.reactor_mass -= mass
+            self.product_count += 1
+            self.product_mass += mass
+        else:
+            n_bonds = self._molecule_bonds(offset, length)
+            self.bonds.add(i, n_bonds)
+            self.total_bonds += n_bonds
+
+    def _new_slot(self):
+        if self.n_molecules == len(self.offset):
+            capacity = 2*len(self.offset)
+            self.offset = np.resize(self.offset, capacity)
+            self.length = np.resize(self.length, capacity)
+            self.in_reactor = np.concatenate([self.in_reactor, np.zeros(capacity-len(self.in_reactor), dtype=bool)])
+            self.bonds.grow(capacity)
+        self.n_molecules += 1
+        self.in_reactor[self.n_molecules-1] = True
+        self.reactor_count += 1
+        return self.n_molecules-1
+
+    def crack(self):
+        '''Cracks one bond. Returns False if there are no bonds left in the reactor.'''
+        if self.total_bonds == 0:
+            return False
+        #select a molecule with the probability of the number of bonds
+        i = self.bonds.find(int(self.rng.integers(self.total_bonds)))
+        offset, length = int(self.offset[i]), int(self.length[i])
+        n_bonds = self.bonds.values[i]
+        #select a bond in the molecule based on the model
+        cumulative = _cumulative_weights(self.model, n_bonds)
+        bond = min(int(np.searchsorted(cumulative, self.rng.random()*cumulative[-1], side='right')), n_bonds-1)
+        position = int(self.bond_positions[self.bond_cumsum[offset] + bond])
+
+        #split the molecule at the selected bond, the right part stays in slot i, the left part gets a new slot
+        self.bonds.add(i, -n_bonds)
+        self.total_bonds -= n_bonds
+        self._place(i, position+1, offset+length-position-1)
+        self._place(self._new_slot(), offset, position-offset)
+        return True
+
+    def step(self, reference_bonds):
+        '''One timestep of the simulation: a bond is cracked with a probability of the bonds in the reactor relative to reference_bonds.'''
+        if self.total_bonds and self.rng.random() < self.total_bonds/reference_bonds:
+            return self.crack()
+        return False
+
+    def status(self):
+        # same output as status(reactor)
+        Mn = self.reactor_mass/self.reactor_count if self.reactor_count else 0
+        return [self.reactor_count, self.reactor_mass, Mn]
+
+    def product_status(self):
+        Mn = self.product_mass/self.product_count if self.product_count else 0
+        return [self.product_count, self.product_mass, Mn]
+
+    def molecules(self, products = False):
+        '''Returns the molecules in the reactor (or the products) as arrays of 1s and 0s.'''
+        selection = np.flatnonzero(self.in_reactor[:self.n_molecules] != products)
+        return [self.units[self.offset[i]:self.offset[i]+self.length[i]] for i in selection]
+
+
+def count_bonds(molecules):
+    # bonds of all molecules in the reactor
+    return sum(int(np.count_nonzero(np.asarray(molecule) == 0)) for molecule in molecules)
+
+
+def run_simulation(molecules, model, steps = 400, min_length = 10, reference_bonds = None, rng = None):
+    '''
+    Runs the fixed-step cracking simulation of the manuscript on an ArrayReactor.
+    molecules is the starting reactor (a list of molecules), reference_bonds the number of bonds the cracking probability is relative to.
+    It defaults to the bonds of the starting reactor, so the first step always cracks. The manuscript cracks one chain of ten
+    201-carbon molecules ([make_molecule(201)*10]) with reference_bonds=200, the bonds of one molecule (see sweep_defaults).
+    Returns the status of reactor and products after every step as two arrays of shape (steps+1, 3) with columns [number, mass, Mn].
+    '''
+    reactor = ArrayReactor(molecules, model, min_length=min_length, rng=rng)
+    if reference_bonds is None:
+        reference_bonds = count_bonds(molecules)
+    reactor_track = np.zeros((steps+1, 3))
+    product_track = np.zeros((steps+1, 3))
+    reactor_track[0] = reactor.status()
+    for j in range(steps):
+        reactor.step(reference_bonds)
+        reactor_track[j+1] = reactor.status()
+        product_track[j+1] = reactor.product_status()
+    return reactor_track, product_track
+
+
+def run_kinetic_simulation(molecules, model, times, rate_constant = None, min_length = 10, rng = None):
+    '''
+    Event-driven (Gillespie) version of run_simulation. Every bond in the reactor cracks with rate_constant (per unit of time),
+    so the waiting time to the next scission is drawn from an exponential distribution with the total rate of all bonds
+    and no time is spent on steps in which nothing happens.
+    Like the cracking probability of run_simulation, the total rate is capped at one scission per unit of time, so with
+    rate_constant=1/reference_bonds a unit of time corresponds to one step of run_simulation with the same reference_bonds.
+    rate_constant defaults to 1/count_bonds(molecules), the default reference_bonds of run_simulation.
+    Returns the status of reactor and products at the times (in the given order) as two arrays of shape (len(times), 3) with columns [number, mass, Mn].
+    '''
+    times = np.asarray(times, dtype=float)
+    reactor = ArrayReactor(molecules, model, min_length=min_length, rng=rng)
+    reactor_track = np.zeros((len(times), 3))
+    product_track = np.zeros((len(times), 3))
+    if reactor.total_bonds == 0:
+        # nothing can be cracked, the status is the same at all times
+        reactor_track[:] = reactor.status()
+        product_track[:] = reactor.product_status()
+        return reactor_track, product_track
+    if rate_constant is None:
+        rate_constant = 1/count_bonds(molecules)
+    # the times are visited in increasing order and the status is written back to their position
+    order = np.argsort(times, kind='stable')
+    t = 0
+    i = 0
+    while i < len(times):
+        if reactor.total_bonds == 0:
+            t = np.inf
+        else:
+            t += reactor.rng.exponential(1/min(rate_constant*reactor.total_bonds, 1))
+        #the status does not change until the next scission
+        while i < len(times) and times[order[i]] < t:
+            reactor_track[order[i]] = reactor.status()
+            product_track[order[i]] = reactor.product_status()
+            i += 1
+        reactor.crack()
+    return reactor_track, product_track
+
+
+
+### Parameter sweeps
+
+# the setup of the manuscript: one chain of n_molecules molecules of n_carbons carbons joined end to end (make_molecule(n_carbons)*n_molecules),
+# cracked relative to reference_bonds, which defaults to the bonds of one molecule (n_carbons-1)
+sweep_defaults = {'model': prob_gaussian, 'min_length': 10, 'steps': 400, 'n_carbons': 201, 'n_molecules': 10, 'reference_bonds': None}
+
+def sweep_grid(**parameters):
+    '''
+    Returns a list of settings for run_sweep from all combinations of the given parameter lists, e.g.
+    sweep_grid(model=[prob_gaussian, prob_exp_fromend], min_length=[5, 10]) gives 4 settings.
+    Parameters that are not given are taken from sweep_defaults.
+    '''
+    names = list(parameters.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+
+def _run_replicate(setting, seed_sequence, column):
+    setting = {**sweep_defaults, **setting}
+    molecules = [make_molecule(setting['n_carbons']) * setting['n_molecules']]
+    reference_bonds = setting['reference_bonds'] if setting['reference_bonds'] is not None else setting['n_carbons']-1
+    reactor_track, product_track = run_simulation(molecules, setting['model'], steps=setting['steps'], min_length=setting['min_length'],
+                                                  reference_bonds=reference_bonds, rng=np.random.default_rng(seed_sequence))
+    return reactor_track[:, column]
+
+def run_sweep(settings, repeats = 5, seed = 0, max_workers = None, output_path = None, column = 1):
+    '''
+    Runs every setting (see sweep_grid) repeats times in a process pool and returns the mean and standard deviation trajectories
+    of the reactor status (column 1 is the mass, 0 the number of molecules and 2 Mn) as arrays of shape (settings, max steps+1),
+    together with all trajectories of shape (settings, repeats, max steps+1). Shorter runs are padded with nan.
+    Every replicate gets its own random stream derived from seed and its (setting, replicate) index, so the results do not depend
+    on the number of workers or the order in which they finish.
+    If output_path is given, the trajectories are written to this .npy file as they come in.
+    Models have to be defined at module level to be sent to the worker processes.
+    '''
+    steps = [{**sweep_defaults, **setting}['steps'] for setting in settings]
+    shape = (len(settings), repeats, max(steps)+1)
+    if output_path is not None:
+        trajectories = np.lib.format.open_memmap(output_path, mode='w+', dtype=float, shape=shape)
+        trajectories[:] = np.nan
+    else:
+        trajectories = np.full(shape, np.nan)
+
+    tasks = [(i, j, np.random.SeedSequence(seed, spawn_key=(i, j))) for i in range(len(settings)) for j in range(repeats)]
+    if max_workers == 1:
+        for i, j, seed_sequence in tasks:
+            trajectories[i, j, :steps[i]+1] = _run_replicate(settings[i], seed_sequence, column)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_run_replicate, settings[i], seed_sequence, column): (i, j) for i, j, seed_sequence in tasks}
+            for future in as_completed(futures):
+                i, j = futures[future]
+                trajectories[i, j, :steps[i]+1] = future.result()
+                if output_path is not None:
+                    trajectories.flush()
+
+    # the nan padding is left out of the statistics, steps without any replicate stay nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(trajectories, axis=1)
+        std = np.nanstd(trajectories, axis=1)
+    return mean, std, trajectories
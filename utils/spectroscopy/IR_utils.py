@@ -6,14 +6,24 @@ import numpy as np
 import xarray as xr
 import os
 from scipy.optimize import curve_fit
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from scipy.integrate import trapezoid
+from scipy.ndimage import uniform_filter1d
 from matplotlib import pyplot as plt
+from utils.misc import time_alignment, file_cache
 
 
-def parse_log(exp_path): #loading the log file and converting the time to a datetime object
+def get_logpath(exp_path):
     try:
         logpath = glob.glob(exp_path + 'log/*.txt')[0]
     except:
         logpath = glob.glob(exp_path + 'Log/*.txt')[0]
+    return logpath
+
+
+def parse_log(exp_path): #loading the log file and converting the time to a datetime object
+    logpath = get_logpath(exp_path)
     log = pd.read_csv(logpath, sep='\t', header=1, names=['Date', 'Time', 'OvenSetpoint', 'OvenTemperature'],engine = 'python')
     log['DateTime'] = pd.to_datetime(log['Date'] + ' ' + log['Time'], format='%m/%d/%Y %I:%M:%S %p')
     #adjusting the timezone
@@ -40,9 +50,8 @@ def get_timestamps(scp_ar): #extracting and converting timestamps from scp array
 
 def add_temp(scp_ar, log,timestamps):
     #adds the temperature as an extra coordinate in the scp xarray
-    indices = np.searchsorted(log['DateTime'], timestamps, side='left')
-    indices = np.clip(indices, 0, len(log['DateTime'])-1)
-    temp_spec = np.array(log['OvenTemperature'][indices].reset_index(drop=True))
+    indices = time_alignment.match_times(log['DateTime'], timestamps, direction='forward') # first log entry at or after the spectrum
+    temp_spec = log['OvenTemperature'].to_numpy()[indices]
     temps = temp_spec
     temps = scp.Coord(temps, title="temperature", units='degree_Celsius')
     c_times=scp_ar.y.copy()
@@ -50,29 +59,154 @@ def add_temp(scp_ar, log,timestamps):
     return scp_ar
 
 
-def xr_convert(scp_ar,background):
-   spectrum = np.abs((-np.log10(scp_ar)+np.log10(background)).data)
+def xr_convert(scp_ar,background, chunks=None):
+   # chunks (e.g. {'time': 500}) gives a lazy, dask-backed DataArray: the absorbance is only calculated chunk by chunk when it is used
    wavenumbers = scp_ar.x.values.magnitude
    timestamps = scp_ar.y['acquisition timestamp (GMT)'].values.magnitude
-   df = pd.DataFrame(spectrum, index=timestamps, columns=wavenumbers)
-   data_array = xr.DataArray(df, dims=["time", "wavenumber"], coords={"time": timestamps, "wavenumber": wavenumbers})
-   data_array["time"] = pd.to_datetime(data_array.time.values, unit="s")
+   coords = {"time": pd.to_datetime(timestamps, unit="s"), "wavenumber": wavenumbers}
+   if chunks is None:
+      spectrum = np.abs((-np.log10(scp_ar)+np.log10(background)).data)
+      data_array = xr.DataArray(spectrum, dims=["time", "wavenumber"], coords=coords)
+   else:
+      data_array = xr.DataArray(scp_ar.data, dims=["time", "wavenumber"], coords=coords).chunk(chunks)
+      data_array = np.abs(-np.log10(data_array) + np.log10(np.asarray(background.data)).reshape(1, -1))
    data_array.coords["temperature"] = ("time", scp_ar.y.temperature.values.magnitude)
    return data_array   
 
 
 
-def get_indices(exp_path,exp_name,save_indices=False,print_indices=True):
+parser_version = 1 # increase when the conversion in load_experiment changes, invalidates cached experiments
+
+def _cache_arrays(data_array):
+    # the absorbance is stored as (wavenumber, time), so that a wavenumber window is one contiguous block on disk
+    return {'absorbance': np.ascontiguousarray(data_array.values.T),
+            'wavenumber': data_array['wavenumber'].values,
+            'time': data_array['time'].values.astype('datetime64[ns]').view('int64'),
+            'temperature': data_array['temperature'].values}
+
+
+def _from_cache(arrays):
+    data_array = xr.DataArray(arrays['absorbance'].T, dims=["time", "wavenumber"], coords={"time": arrays['time'].view('datetime64[ns]'), "wavenumber": np.asarray(arrays['wavenumber'])})
+    data_array.coords["temperature"] = ("time", np.asarray(arrays['temperature']))
+    return data_array
+
+
+def load_experiment(exp_path, cache_dir=file_cache.default_dir, chunks=None):
+    '''
+    Absorbance spectra of an experiment as (time, wavenumber) DataArray with the temperature, as from parse_log, read_omnic, get_timestamps, add_temp and xr_convert.
+    The converted spectra are cached in cache_dir (see utils.misc.file_cache), keyed on the .SPG, background .SPA and log file.
+    Cached spectra are memory-mapped: opening is instant and only the spectra and wavenumber windows that are used are read from disk.
+    cache_dir=None converts without caching.
+    chunks (e.g. {'time': 500}) returns a lazy, dask-backed DataArray for series that do not fit in memory: slices, baselines and fits
+    then run chunk by chunk, reading from the memory-mapped cache.
+    '''
+    spectra_path = glob.glob(exp_path +'/spectra_all'+ '/*.SPG')[0]
+    background_path = glob.glob(exp_path +'/background'+ '/*.SPA')[0]
+    sources = [spectra_path, background_path, get_logpath(exp_path)]
+    if cache_dir is not None:
+        key = file_cache.cache_key(sources, 'IR_utils.load_experiment {}'.format(parser_version))
+        cached = file_cache.load(key, cache_dir)
+        if cached is not None:
+            data_array = _from_cache(cached[0])
+            return data_array if chunks is None else data_array.chunk(chunks)
+
+    log = parse_log(exp_path)
+    scp_ar = scp.read_omnic(spectra_path)
+    background = scp.read_omnic(background_path)
+    timestamps = get_timestamps(scp_ar)
+    scp_ar = add_temp(scp_ar, log, timestamps)
+    data_array = xr_convert(scp_ar, background)
+    if cache_dir is not None:
+        file_cache.store(key, _cache_arrays(data_array), sources=sources, cache_dir=cache_dir)
+    return data_array if chunks is None else data_array.chunk(chunks)
+
+
+
+index_names = ['start_bl', 'end_bl', 'start_dose', 'end_dose', 'start_desorb', 'end_desorb', 'start_dry', 'end_dry', '150_plateau']
+
+def _runs(labels, value, min_run):
+    # start and stop of the runs of labels == value that are at least min_run long
+    is_value = np.concatenate([[False], labels == value, [False]])
+    edges = np.flatnonzero(np.diff(is_value.astype(int)))
+    starts, stops = edges[0::2], edges[1::2]
+    keep = stops - starts >= min_run
+    return starts[keep], stops[keep]
+
+
+def band_signal(data_array, band=(1560, 1530)):
+    '''Area of the band between band[0] and band[1] (wavenumbers) above the straight line between its edges, for every spectrum.'''
+    window = data_array.sel(wavenumber=slice(band[0], band[1]))
+    x = window['wavenumber'].values.astype(float)
+    y = np.atleast_2d(window.values).astype(float)
+    line = y[:,:1] + (y[:,-1:] - y[:,:1])*(x - x[0])/(x[-1] - x[0])
+    return np.abs(trapezoid(y - line, x, axis=1))
+
+
+def detect_indices(data_array, band=(1560, 1530), rate_tol=0.5, dose_fraction=0.05, smooth=5, min_run=3):
+    '''
+    Finds the phases of a dosing experiment (as in the indices files, see get_indices) from the temperature coordinate and the band area of the probe molecule.
+    The temperature rate (degC/min, per spectrum if time is not a datetime) is smoothed over smooth spectra and labelled as heating, cooling
+    or plateau with rate_tol; the change points are the starts of runs of at least min_run spectra.
+    Drying ends where the first cooling starts, the baseline spectra are acquired during the cooling and on the plateau before dosing.
+    Dosing starts where the band area rises above the baseline level by dose_fraction of its maximum rise and ends where it drops below
+    1-dose_fraction of the maximum again, when the evacuation starts.
+    The desorption continues from there, 150_plateau is where its heating ramp starts, and ends where the temperature drops again (or at the end).
+    Accuracy: the boundaries from the temperature and start_dose are within about one spectrum of the manual indices. end_dose is only found
+    once the band has dropped by dose_fraction, so it lands after the start of the evacuation (7-8 spectra late for a band losing 10%
+    with a decay of 10 spectra), and the first spectra of the evacuation end up in the dosing. Check the indices before relying on them.
+    '''
+    temps = uniform_filter1d(np.asarray(data_array['temperature'].values, dtype=float), smooth, mode='nearest')
+    n = len(temps)
+    times = data_array['time'].values
+    if np.issubdtype(times.dtype, np.datetime64):
+        minutes = (times - times[0])/np.timedelta64(1, 'm')
+    else:
+        minutes = np.arange(n, dtype=float)
+    rate = np.gradient(temps, minutes) if n > 1 else np.zeros(n)
+    labels = np.where(rate > rate_tol, 1, np.where(rate < -rate_tol, -1, 0))
+    heating_starts, heating_stops = _runs(labels, 1, min_run)
+    cooling_starts, cooling_stops = _runs(labels, -1, min_run)
+    if len(cooling_starts) == 0:
+        raise ValueError('No cooling after drying found in the temperature')
+
+    end_dry = int(cooling_starts[0])
+    start_bl = end_dry + 1
+    end_cooling = int(cooling_stops[0])
+    signal = uniform_filter1d(band_signal(data_array, band), smooth, mode='nearest')
+    base_level = np.median(signal[start_bl:max(end_cooling, start_bl+1)])
+    ramps = heating_starts[heating_starts > end_cooling]
+    plateau = int(ramps[0]) if len(ramps) else n # dosing and evacuation at the plateau before the heating ramp of the desorption
+    rise = signal[end_cooling:plateau] - base_level
+    if len(rise) == 0 or rise.max() <= 0:
+        raise ValueError('No dosing found in the band area')
+    start_dose = end_cooling + int(np.argmax(rise > dose_fraction*rise.max()))
+    end_dose = end_cooling + int(np.flatnonzero(rise >= (1-dose_fraction)*rise.max())[-1]) + 1 # end of the saturation, before the evacuation lowers the band
+    coolings = cooling_starts[cooling_starts > plateau]
+    end_desorb = int(coolings[0]) if len(coolings) else n
+    values = [start_bl, start_dose - 1, start_dose, end_dose, end_dose + 1, end_desorb, 0, end_dry, plateau]
+    return dict(zip(index_names, values))
+
+
+def get_indices(exp_path,exp_name,save_indices=False,print_indices=True, data_array=None, band=(1560, 1530)):
+    # with data_array, indices that are not in a file yet are detected automatically (see detect_indices), and saved next to the data with save_indices
     if any('indices' in s for s in os.listdir(exp_path)):
 
         #load the indices file
         filen_name = glob.glob(exp_path + '*indices*')[0]
 
-        indices = pd.read_csv(filen_name, skiprows=1, names=['start_bl', 'end_bl', 'start_dose', 'end_dose', 'start_desorb', 'end_desorb', 'start_dry', 'end_dry', '150_plateau'], engine='python')
+        indices = pd.read_csv(filen_name, skiprows=1, names=index_names, engine='python')
         start_bl, end_bl, start_dose, end_dose, start_desorb, end_desorb, start_dry, end_dry, index_150_plateau = indices.iloc[0]
         if print_indices == True:
             print('indices file found')
             print(indices)
+    elif data_array is not None:
+        index_lib = detect_indices(data_array, band)
+        if save_indices == True:
+            pd.DataFrame(index_lib, index=[0]).to_csv(exp_path+exp_name+'_cutoff_indices.csv',index=False)
+        if print_indices == True:
+            print('indices detected')
+            print(index_lib)
+        return index_lib
     else:
         print('no indices file found, please define the indices manually')
         #for Z11
@@ -158,17 +292,239 @@ def gaussian(x, x0, sigma, A):
     return A * np.exp(-(x-x0)**2 / (2*sigma**2))
 
 
-
-def baseline_substract(bl_array,spectra_array): # for each spectrum, look up the specturm in the baseline array which has the closest temperature and substract it
-    bl_temps = np.array(bl_array['temperature'])
-    spectra_temps = np.array(spectra_array['temperature'])
-    closest_indices = []
-    for element in spectra_temps:
-        closest_index = np.abs(bl_temps - element).argmin()
-        closest_indices.append(closest_index)
-    
-    closest_temp_spectra = np.array(bl_array[closest_indices])
-    spectra_array_corr = spectra_array - closest_temp_spectra
+def _peak_jacobian(x, params, fit_select):
+    # model and derivatives to (x0, width, A) of all spectra at once. x: (points,), params: (spectra, 3)
+    x0, width, A = params[:,0:1], params[:,1:2], params[:,2:3]
+    d = x - x0
+    if fit_select == 'lorentzian':
+        D = d**2 + width**2
+        shape = width**2/D
+        jacobian = np.stack([2*A*shape*d/D, 2*A*width*d**2/D**2, shape], axis=-1)
+    elif fit_select == 'gaussian':
+        shape = np.exp(-d**2/(2*width**2))
+        jacobian = np.stack([A*shape*d/width**2, A*shape*d**2/width**3, shape], axis=-1)
+    else:
+        raise ValueError('fit_select must be lorentzian or gaussian')
+    return A*shape, jacobian
+
+
+def _peak_area(params, pcov, fit_select):
+    # area of the peak and its standard error from the covariance of (width, A)
+    factor = np.pi if fit_select == 'lorentzian' else np.sqrt(2*np.pi)
+    width, A = params[:,1], params[:,2]
+    var = A**2*pcov[:,1,1] + width**2*pcov[:,2,2] + 2*width*A*pcov[:,1,2]
+    return factor*width*A, factor*np.sqrt(np.abs(var))
+
+
+def fit_peaks(dataset, peak_loc, peak_window=25, fit_window=15, fit_select='lorentzian', baseline=None, max_iter=200, ftol=1.49012e-8, xtol=1.49012e-8, chunksize=None, max_workers=None):
+    '''
+    Fits one peak in all spectra of a (time, wavenumber) DataArray at once, with the same windows as fit_integrate_peak
+    (maximum within peak_loc +- peak_window, fit within +- fit_window around the maximum, but not outside the finding window).
+    The fit starts at the maximum and its half width.
+    baseline=(start, end) subtracts the linear baseline of linear_bl_corr first, but only in the window.
+    The window is sliced once, and all spectra are fitted together by Levenberg-Marquardt with analytic derivatives.
+    The few spectra that do not converge within max_iter are fitted by curve_fit.
+    Fits with a width <= 0 are rejected (NaN parameters and integral), and the integral keeps the sign of the amplitude.
+    For a dask-backed dataset (lazy mode, see load_experiment) or with chunksize, the spectra are read and fitted in blocks along time,
+    in a thread pool (max_workers=1 for serial), so only the window of one block per worker is in memory.
+    Returns a frame with the area ('integral'), peak intensity, parameters and their standard errors, one row per spectrum.
+    '''
+    outer = dataset.sel(wavenumber=slice(peak_loc+peak_window, peak_loc-peak_window))
+    if baseline is not None:
+        i1, i2 = dataset.indexes['wavenumber'].get_indexer(list(baseline), method='nearest')
+        baseline_points = dataset.isel(wavenumber=[i1, i2])
+    x = outer['wavenumber'].values.astype(float)
+
+    def fit_block(rows):
+        y = np.atleast_2d(outer[rows].values).astype(float)
+        if baseline is not None:
+            y1, y2 = np.atleast_2d(baseline_points[rows].values).T[:,:,None]
+            m = (y2-y1)/(baseline[1]-baseline[0])
+            y = y - (m*x + y1 - m*baseline[0])
+        return _fit_window(x, y, peak_loc, peak_window, fit_window, fit_select, max_iter, ftol, xtol)
+
+    n = outer.sizes['time'] if outer.ndim == 2 else 1
+    if outer.ndim == 2 and outer.chunks is not None:
+        sizes = outer.chunksizes['time']
+    elif chunksize is not None:
+        sizes = [chunksize]*(n//chunksize) + ([n % chunksize] if n % chunksize else [])
+    else:
+        sizes = [n]
+    bounds = np.cumsum([0] + list(sizes))
+    blocks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])] if outer.ndim == 2 else [Ellipsis]
+    if max_workers == 1 or len(blocks) < 2:
+        frames = [fit_block(rows) for rows in blocks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            frames = list(executor.map(fit_block, blocks))
+    frame = pd.concat(frames, ignore_index=True)
+    if 'temperature' in dataset.coords and dataset['temperature'].ndim == 1:
+        frame.insert(0, 'temperature', dataset['temperature'].values)
+    return frame
+
+
+def _fit_window(x, y, peak_loc, peak_window, fit_window, fit_select, max_iter, ftol, xtol):
+    # batch fit of the spectra y (spectra, points) on the wavenumbers x, see fit_peaks
+    # finding window and the fit window around the maximum of every spectrum (inclusive, like sel with a slice).
+    # As in fit_integrate_peak, the fit window is cut from the finding window, peaks near its edge are fitted on fewer points.
+    in_peak = (x <= peak_loc+peak_window) & (x >= peak_loc-peak_window)
+    y_peak = np.where(in_peak, y, -np.inf)
+    i_max = np.argmax(y_peak, axis=1)
+    intensity = y_peak[np.arange(len(y)), i_max]
+    x_max = x[i_max]
+    weights = (in_peak & (x >= (x_max-fit_window)[:,None]) & (x <= (x_max+fit_window)[:,None])).astype(float)
+    n_points = weights.sum(axis=1)
+
+    # starting values from the data: half width at half maximum from the points above half the maximum
+    spacing = np.abs(np.median(np.diff(x)))
+    hwhm = np.maximum(np.sum(weights*(y >= intensity[:,None]/2), axis=1), 1)*spacing/2
+    width0 = hwhm if fit_select == 'lorentzian' else hwhm/np.sqrt(2*np.log(2))
+    params = np.column_stack([x_max, width0, intensity])
+    model, jacobian = _peak_jacobian(x, params, fit_select)
+    residual = weights*(y - model)
+    cost = np.sum(residual**2, axis=1)
+    damping = np.full(len(y), 1e-3)
+    converged = np.zeros(len(y), dtype=bool)
+    for iteration in range(max_iter):
+        active = ~converged
+        if not active.any():
+            break
+        J = jacobian[active]*weights[active][:,:,None]
+        JTJ = np.einsum('npi,npj->nij', J, J)
+        JTr = np.einsum('npi,np->ni', J, residual[active])
+        scaled = JTJ + damping[active][:,None,None]*np.einsum('nii->ni', JTJ)[:,:,None]*np.eye(3)
+        try:
+            step = np.linalg.solve(scaled, JTr[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(scaled) @ JTr[:,:,None])[:,:,0]
+        trial = params[active] + step
+        trial_model, trial_jacobian = _peak_jacobian(x, trial, fit_select)
+        trial_residual = weights[active]*(y[active] - trial_model)
+        trial_cost = np.sum(trial_residual**2, axis=1)
+        # steps that move the peak out of the fit window, make the width negative or much wider than the window are rejected,
+        # otherwise a flat, infinitely wide peak can be approached from poor starting values
+        plausible = (np.abs(trial[:,0] - x_max[active]) <= fit_window) & (trial[:,1] > 0) & (trial[:,1] <= 10*fit_window)
+        better = np.isfinite(trial_cost) & (trial_cost <= cost[active]) & plausible
+
+        index = np.flatnonzero(active)
+        accepted = index[better]
+        small_cost = (cost[accepted] - trial_cost[better]) <= ftol*cost[accepted]
+        small_step = np.all(np.abs(step[better]) <= xtol*(np.abs(params[accepted]) + xtol), axis=1)
+        params[accepted] = trial[better]
+        model[accepted] = trial_model[better]
+        jacobian[accepted] = trial_jacobian[better]
+        residual[accepted] = trial_residual[better]
+        cost[accepted] = trial_cost[better]
+        damping[accepted] /= 10
+        damping[index[~better]] *= 10
+        converged[accepted[small_cost | small_step]] = True
+        converged[index[~better][damping[index[~better]] > 1e16]] = True # no further improvement possible
+
+    for i in np.flatnonzero(~converged): # fallback for the spectra that did not converge
+        select = weights[i] > 0
+        try:
+            params[i] = curve_fit(lorentzian if fit_select == 'lorentzian' else gaussian, x[select], y[i, select], p0=[x_max[i], 30, 0.2])[0]
+        except RuntimeError:
+            params[i] = np.nan
+        if not params[i,1] > 0: # negative width, the model is symmetric in it but the fit is not trusted
+            params[i] = np.nan
+
+    # covariance as in curve_fit: residual variance times the inverse of J^T J
+    model, jacobian = _peak_jacobian(x, params, fit_select)
+    cost = np.sum((weights*(y - model))**2, axis=1)
+    J = jacobian*weights[:,:,None]
+    JTJ = np.einsum('npi,npj->nij', J, J)
+    dof = np.maximum(n_points - 3, 1)
+    pcov = np.full(JTJ.shape, np.nan)
+    finite = np.all(np.isfinite(JTJ), axis=(1,2))
+    pcov[finite] = np.linalg.pinv(JTJ[finite])*(cost[finite]/dof[finite])[:,None,None]
+    area, area_error = _peak_area(params, pcov, fit_select)
+    errors = np.sqrt(np.abs(np.einsum('nii->ni', pcov)))
+    frame = pd.DataFrame({'integral': area, 'integral_error': area_error, 'intensity': intensity,
+                          'x0': params[:,0], 'x0_error': errors[:,0], 'width': params[:,1], 'width_error': errors[:,1],
+                          'amplitude': params[:,2], 'amplitude_error': errors[:,2]})
+    return frame
+
+
+
+def closest_temperatures(bl_temps, temps):
+    '''
+    Index of the baseline spectrum with the closest temperature for every temperature, the first one if several are equally close (like argmin).
+    The baseline temperatures are sorted once and matched with searchsorted, O((n + m) log n).
+    '''
+    bl_temps = np.asarray(bl_temps, dtype=float)
+    temps = np.asarray(temps, dtype=float)
+    order = np.argsort(bl_temps, kind='stable')
+    sorted_temps = bl_temps[order]
+    n = len(sorted_temps)
+    after = np.clip(np.searchsorted(sorted_temps, temps, side='left'), 0, n-1)
+    before = np.clip(after - 1, 0, n-1)
+    # first of equal temperatures, which has the lowest index because of the stable sort
+    after = np.searchsorted(sorted_temps, sorted_temps[after], side='left')
+    before = np.searchsorted(sorted_temps, sorted_temps[before], side='left')
+    d_before = np.abs(temps - sorted_temps[before])
+    d_after = np.abs(sorted_temps[after] - temps)
+    i_before, i_after = order[before], order[after]
+    return np.where((d_before < d_after) | ((d_before == d_after) & (i_before < i_after)), i_before, i_after)
+
+
+def bracketing_temperatures(bl_temps, temps):
+    # indices of the baseline spectra below and above every temperature and the weight of the one above, for linear interpolation.
+    # Outside of the baseline temperatures the first or last spectrum is used.
+    bl_temps = np.asarray(bl_temps, dtype=float)
+    temps = np.asarray(temps, dtype=float)
+    order = np.argsort(bl_temps, kind='stable')
+    sorted_temps = bl_temps[order]
+    n = len(sorted_temps)
+    above = np.clip(np.searchsorted(sorted_temps, temps, side='left'), 0, n-1)
+    below = np.clip(np.searchsorted(sorted_temps, temps, side='right') - 1, 0, n-1)
+    span = sorted_temps[above] - sorted_temps[below]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(span > 0, (temps - sorted_temps[below])/span, 0.0)
+    return order[below], order[above], weight
+
+
+def _matched_baseline(bl_values, match, rows, columns=slice(None)):
+    # baseline spectra for the spectra in rows, match is (closest_indices,) or (below, above, weight) for interpolation
+    if len(match) == 1:
+        return bl_values[match[0][rows], columns]
+    below, above, weight = match
+    w = weight[rows, None]
+    return (1-w)*bl_values[below[rows], columns] + w*bl_values[above[rows], columns]
+
+
+def _substract_block(block, bl_values, match, block_info=None):
+    # one chunk of a dask-backed spectra array
+    (start, stop), (first, last) = block_info[0]['array-location']
+    return block - _matched_baseline(bl_values, match, slice(start, stop), slice(first, last))
+
+
+def baseline_substract(bl_array, spectra_array, interpolate=False, inplace=False, chunksize=1024):
+    '''
+    For each spectrum, look up the spectrum in the baseline array which has the closest temperature and substract it.
+    interpolate=True interpolates linearly between the baseline spectra at the temperatures below and above instead.
+    The baselines are built and subtracted chunksize spectra at a time, inplace=True subtracts from spectra_array itself.
+    WARNING: inplace=True writes into the data of spectra_array, which slices (split_experiment, get_slice, isel/sel) share with the array
+    they were taken from. The parent array and all other slices of it change as well, so only pass arrays you own (e.g. spectra_array.copy()).
+    Spectra memory-mapped from the cache are copy-on-write, the cache file itself is not changed.
+    A dask-backed spectra_array (lazy mode) stays lazy, the baselines are subtracted chunk by chunk when the spectra are used.
+    Lazy arrays have no data to write into, inplace=True raises a ValueError for them.
+    '''
+    bl_values = np.asarray(bl_array)
+    if interpolate:
+        match = bracketing_temperatures(bl_array['temperature'], spectra_array['temperature'])
+    else:
+        match = (closest_temperatures(bl_array['temperature'], spectra_array['temperature']),)
+
+    if spectra_array.chunks is not None:
+        if inplace:
+            raise ValueError('inplace=True is not possible for a dask-backed (lazy) spectra_array')
+        return spectra_array.copy(data=spectra_array.data.map_blocks(partial(_substract_block, bl_values=bl_values, match=match), dtype=float))
+    spectra_array_corr = spectra_array if inplace else spectra_array.copy()
+    values = spectra_array_corr.values
+    for start in range(0, len(values), chunksize):
+        chunk = slice(start, start+chunksize)
+        values[chunk] -= _matched_baseline(bl_values, match, chunk)
     return spectra_array_corr
 
 
@@ -194,11 +550,9 @@ def cut_TPD_dataset(dataset):
 def get_tpd_BAS(dataset,pelettweight,peakloc=1545.0):
     dataset_p = cut_TPD_dataset(dataset)
     temps = dataset_p['temperature'].values
-    integrals = []
-    for i in range(len(dataset_p)):
-        data_bl= linear_bl_corr(dataset_p[i])
-        integral,intesity = fit_integrate_peak(data_bl, peakloc, 25, 15, 'lorentzian', plot=False)
-        integrals.append(integral)
+    # linear baseline and lorentzian fit of all spectra at once, see fit_peaks
+    fits = fit_peaks(dataset_p, peakloc, 25, 15, 'lorentzian', baseline=(1564, 1508))
+    integrals = fits['integral'].to_numpy()
     df = pd.DataFrame({'temperature':temps,'integral':integrals,'integral_byweight':np.array(integrals)/pelettweight})
     return df
     